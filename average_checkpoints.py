@@ -7,6 +7,7 @@ import argparse
 import math
 import numpy
 from onmt.ModelConstructor import build_model
+from onmt.inference.Release import load_checkpoint
 
 
 parser = argparse.ArgumentParser(description='translate.py')
@@ -40,7 +41,7 @@ def main():
     n_models = len(models)
     
     print("Loading main model from %s ..." % models[0])
-    checkpoint = torch.load(models[0], map_location=lambda storage, loc: storage)
+    checkpoint = load_checkpoint(models[0])
     
     if 'optim' in checkpoint:
         del checkpoint['optim']
@@ -61,7 +62,7 @@ def main():
 
         model = models[i]
         print("Loading model from %s ..." % models[i])
-        checkpoint = torch.load(model, map_location=lambda storage, loc: storage)
+        checkpoint = load_checkpoint(model)
 
         model_opt = checkpoint['opt']
         
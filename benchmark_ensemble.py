@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+from __future__ import division
+
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+import onmt.Constants
+from onmt.inference.Ensemble import EnsembleCombiner
+
+parser = argparse.ArgumentParser(description='benchmark_ensemble.py')
+
+parser.add_argument('-batch_size', type=int, default=64,
+                    help='Number of sentences times the beam size')
+parser.add_argument('-vocab_size', type=int, default=32000,
+                    help='Size of the output vocabulary')
+parser.add_argument('-models', default='2|4|8',
+                    help='Numbers of models in the ensemble, separated by |')
+parser.add_argument('-ops', default='mean|logSum|gmean|max|min',
+                    help='Ensemble operators, separated by |')
+parser.add_argument('-steps', type=int, default=100,
+                    help='Number of timed combinations')
+parser.add_argument('-fp16', action='store_true',
+                    help='Outputs of the models in half precision')
+parser.add_argument('-gpu', type=int, default=-1,
+                    help='Device to run on')
+
+
+def sequential_combine(op, outputs):
+    """ The former combination in probability space, as a reference """
+    if op in ['logSum', 'gmean']:
+        output = outputs[0].clone()
+        for i in range(1, len(outputs)):
+            output += outputs[i]
+        return F.log_softmax(output.div_(len(outputs)), dim=-1)
+    elif op == 'mean':
+        output = torch.exp(outputs[0])
+        for i in range(1, len(outputs)):
+            output += torch.exp(outputs[i])
+        return torch.log(output.div_(len(outputs)))
+    elif op == 'max':
+        output = outputs[0]
+        for i in range(1, len(outputs)):
+            output = torch.max(output, outputs[i])
+        return output
+    else:
+        output = outputs[0]
+        for i in range(1, len(outputs)):
+            output = torch.min(output, outputs[i])
+        return output
+
+
+def timeit(fn, steps, cuda):
+    fn()
+    if cuda:
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(steps):
+        fn()
+    if cuda:
+        torch.cuda.synchronize()
+
+    return (time.time() - start) / steps * 1000
+
+
+def main():
+    opt = parser.parse_args()
+    cuda = opt.gpu > -1
+    device = torch.device('cuda', opt.gpu) if cuda else torch.device('cpu')
+
+    print("| %6s | %6s | %15s | %14s | %9s |" % ('op', 'models', 'sequential (ms)', 'combiner (ms)', 'max diff'))
+
+    for n_models in [int(n) for n in opt.models.split("|")]:
+        logits = torch.randn(n_models, opt.batch_size, opt.vocab_size, device=device) * 5
+        outputs = [F.log_softmax(logits[i], dim=-1) for i in range(n_models)]
+        # a token blocked by every model (as the decoder does for PAD) has to stay -inf, not become NaN
+        for output in outputs:
+            output[:, onmt.Constants.PAD] = float('-inf')
+        if opt.fp16:
+            outputs = [output.half() for output in outputs]
+
+        for op in opt.ops.split("|"):
+            combiner = EnsembleCombiner(op)
+
+            # the reference runs in float, as in fp16 exp() underflows
+            reference = sequential_combine(op, [output.float() for output in outputs])
+            combined = combiner(outputs)
+            finite = torch.isfinite(reference)
+            diff = (combined - reference)[finite].abs().max().item()
+            if not torch.equal(combined[~finite], reference[~finite]):
+                diff = float('nan')
+
+            sequential_time = timeit(lambda: sequential_combine(op, outputs), opt.steps, cuda)
+            combiner_time = timeit(lambda: combiner(outputs), opt.steps, cuda)
+
+            print("| %6s | %6d | %15.3f | %14.3f | %9.2e |" % (op, n_models, sequential_time, combiner_time, diff))
+
+
+if __name__ == "__main__":
+    main()
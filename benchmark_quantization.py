@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+from __future__ import division
+
+import time
+import math
+from collections import Counter
+import torch
+import onmt
+from translate import parser, getSentenceFromTokens
+
+# the decoding options are the ones of translate.py (-model, -src, -tgt, -beam_size, -fast_translate ...)
+parser.description = 'benchmark_quantization.py'
+parser.add_argument('-threads', type=int, default=0,
+                    help='Number of intra-op threads (0 for the default of pytorch)')
+
+
+def corpus_bleu(references, hypotheses, max_order=4):
+    """ BLEU (in percent) of a list of tokenized hypotheses, with one reference each """
+    matches, totals = [0] * max_order, [0] * max_order
+    ref_length, hyp_length = 0, 0
+
+    for ref, hyp in zip(references, hypotheses):
+        for n in range(max_order):
+            ref_ngrams = Counter(tuple(ref[i:i + n + 1]) for i in range(len(ref) - n))
+            hyp_ngrams = Counter(tuple(hyp[i:i + n + 1]) for i in range(len(hyp) - n))
+            matches[n] += sum((hyp_ngrams & ref_ngrams).values())
+            totals[n] += max(len(hyp) - n, 0)
+        ref_length += len(ref)
+        hyp_length += len(hyp)
+
+    if min(matches) == 0:
+        return 0.0
+
+    log_precision = sum(math.log(matches[n] / totals[n]) for n in range(max_order)) / max_order
+    brevity_penalty = min(1.0 - ref_length / hyp_length, 0.0)
+
+    return 100 * math.exp(log_precision + brevity_penalty)
+
+
+def translate_all(opt, src_sents):
+    """ Translate the whole source with the given quantization, returns the hypotheses and the time """
+    if opt.fast_translate:
+        from onmt.inference.FastTranslator import FastTranslator
+        translator = FastTranslator(opt)
+    else:
+        translator = onmt.Translator(opt)
+
+    # warm up on the first batch
+    translator.translate(src_sents[:opt.batch_size], [])
+
+    hypotheses = list()
+    start = time.time()
+    for i in range(0, len(src_sents), opt.batch_size):
+        pred_batch = translator.translate(src_sents[i:i + opt.batch_size], [])[0]
+        hypotheses += [getSentenceFromTokens(pred[0], opt.input_type).split() for pred in pred_batch]
+
+    return hypotheses, time.time() - start
+
+
+def main():
+    opt = parser.parse_args()
+    opt.cuda = False
+    opt.fp16 = False
+    opt.n_best = 1
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    src_sents = [line.split() for line in open(opt.src)]
+    references = [line.split() for line in open(opt.tgt)] if opt.tgt else None
+
+    results = dict()
+    for quantize in ['', 'int8']:
+        opt.quantize = quantize
+        results[quantize] = translate_all(opt, src_sents)
+
+    # without reference, the int8 translations are scored against the float ones
+    print("| %6s | %10s | %8s | %10s |" % ('model', 'sents/sec', 'BLEU', 'BLEU delta'))
+
+    for quantize in ['', 'int8']:
+        hypotheses, elapsed = results[quantize]
+        if references is not None:
+            bleu = corpus_bleu(references, hypotheses)
+            base_bleu = corpus_bleu(references, results[''][0])
+        else:
+            bleu = corpus_bleu(results[''][0], hypotheses)
+            base_bleu = 100.0
+
+        print("| %6s | %10.2f | %8.2f | %+10.2f |" % (quantize if quantize else 'fp32', len(src_sents) / elapsed,
+                                                       bleu, bleu - base_bleu))
+
+
+if __name__ == "__main__":
+    main()
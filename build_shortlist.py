@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+from __future__ import division
+
+import onmt
+import onmt.Markdown
+import torch
+import argparse
+import numpy as np
+
+parser = argparse.ArgumentParser(description='build_shortlist.py')
+onmt.Markdown.add_md_help_argument(parser)
+
+parser.add_argument('-data', required=True,
+                    help='Path to the preprocessed data (prefix given to preprocess.py -save_data)')
+parser.add_argument('-data_format', default='raw',
+                    help='Format of the preprocessed data: raw|bin|mmem')
+parser.add_argument('-output', required=True,
+                    help='Path to the output shortlist table')
+parser.add_argument('-topk', type=int, default=50,
+                    help='Number of target words kept for each source word')
+parser.add_argument('-frequent', type=int, default=100,
+                    help='Number of most frequent target words always in the shortlist')
+parser.add_argument('-chunk_size', type=int, default=100000,
+                    help='Number of sentence pairs counted at once')
+
+
+def load_data(opt):
+
+    if opt.data_format == 'raw':
+        path = opt.data if opt.data.endswith('.train.pt') else opt.data + '.train.pt'
+        print("Loading data from %s" % path)
+        dataset = torch.load(path)
+        if dataset.get('type', 'text') != 'text':
+            raise NotImplementedError("A shortlist can only be built for text sources")
+        return dataset['dicts'], dataset['train']['src'], dataset['train']['tgt']
+    elif opt.data_format == 'bin':
+        from onmt.data_utils.IndexedDataset import IndexedInMemoryDataset
+        dicts = torch.load(opt.data + '.dict.pt')
+        return dicts, IndexedInMemoryDataset(opt.data + '.train.src'), IndexedInMemoryDataset(opt.data + '.train.tgt')
+    elif opt.data_format == 'mmem':
+        from onmt.data_utils.MMapIndexedDataset import MMapIndexedDataset
+        dicts = torch.load(opt.data + '.dict.pt')
+        return dicts, MMapIndexedDataset(opt.data + '.train.src'), MMapIndexedDataset(opt.data + '.train.tgt')
+    else:
+        raise NotImplementedError("Data format unknown")
+
+
+def merge_counts(keys, counts):
+    keys, inverse = np.unique(keys, return_inverse=True)
+    return keys, np.bincount(inverse, weights=counts).astype(np.int64)
+
+
+def count_cooccurrences(src_data, tgt_data, src_size, tgt_size, chunk_size):
+    """
+    Count in how many sentence pairs each source word, target word and (source, target) pair occurs
+    :return: source counts, target counts, pair keys (src * tgt_size + tgt) and their counts
+    """
+    special = np.array([onmt.Constants.PAD, onmt.Constants.BOS, onmt.Constants.EOS])
+
+    src_count = np.zeros(src_size, dtype=np.int64)
+    tgt_count = np.zeros(tgt_size, dtype=np.int64)
+    pair_keys = np.zeros(0, dtype=np.int64)
+    pair_count = np.zeros(0, dtype=np.int64)
+
+    chunk = []
+    for i in range(len(src_data)):
+        src = np.unique(np.asarray(src_data[i], dtype=np.int64))
+        tgt = np.unique(np.asarray(tgt_data[i], dtype=np.int64))
+        src = src[~np.isin(src, special)]
+        tgt = tgt[~np.isin(tgt, special)]
+
+        src_count[src] += 1
+        tgt_count[tgt] += 1
+        chunk.append((src[:, None] * tgt_size + tgt[None, :]).reshape(-1))
+
+        if len(chunk) == chunk_size or i == len(src_data) - 1:
+            keys = np.concatenate(chunk)
+            pair_keys, pair_count = merge_counts(np.concatenate([pair_keys, keys]),
+                                                 np.concatenate([pair_count, np.ones_like(keys)]))
+            chunk = []
+            print("Counted %d sentence pairs, %d word pairs" % (i + 1, len(pair_keys)), flush=True)
+
+    return src_count, tgt_count, pair_keys, pair_count
+
+
+def main():
+    opt = parser.parse_args()
+
+    dicts, src_data, tgt_data = load_data(opt)
+    src_size, tgt_size = dicts['src'].size(), dicts['tgt'].size()
+
+    src_count, tgt_count, pair_keys, pair_count = count_cooccurrences(src_data, tgt_data, src_size, tgt_size,
+                                                                      opt.chunk_size)
+
+    # association of the word pairs: Dice coefficient of the sentence co-occurrences
+    src_ids, tgt_ids = pair_keys // tgt_size, pair_keys % tgt_size
+    dice = 2.0 * pair_count / (src_count[src_ids] + tgt_count[tgt_ids])
+
+    # keep the topk target words of each source word
+    order = np.lexsort((-dice, src_ids))
+    src_ids, tgt_ids = src_ids[order], tgt_ids[order]
+    group_start = np.searchsorted(src_ids, src_ids, side='left')
+    rank = np.arange(len(src_ids)) - group_start
+    keep = rank < opt.topk
+
+    table = torch.LongTensor(src_size, opt.topk).fill_(onmt.Constants.PAD)
+    table[torch.from_numpy(src_ids[keep]), torch.from_numpy(rank[keep])] = torch.from_numpy(tgt_ids[keep])
+
+    frequent = torch.from_numpy(np.argsort(-tgt_count, kind='stable')[:opt.frequent].copy())
+
+    print("Saving the shortlist table (%d source words x %d, %d frequent words) to %s"
+          % (src_size, opt.topk, len(frequent), opt.output))
+    torch.save({'table': table, 'frequent': frequent}, opt.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+from __future__ import division
+
+import os
+import argparse
+import torch
+from onmt.ModelConstructor import build_model
+from onmt.inference.Release import load_checkpoint
+from onmt.inference.Scripted import export_scripted_model
+
+
+parser = argparse.ArgumentParser(description='export_torchscript.py')
+
+parser.add_argument('-model', required=True,
+                    help='Path to model .pt file')
+parser.add_argument('-output', default='model.script.pt',
+                    help="""Path to the TorchScript archive, which is given to translate.py as -model""")
+parser.add_argument('-quantize', default='',
+                    help="""Quantize the linear layers of the exported model for decoding on CPU: int8""")
+
+
+def main():
+
+    opt = parser.parse_args()
+
+    print("Loading model from %s ..." % opt.model)
+    checkpoint = load_checkpoint(opt.model)
+
+    model_opt = checkpoint['opt']
+    dicts = checkpoint['dicts']
+
+    model = build_model(model_opt, dicts)
+    model.load_state_dict(checkpoint['model'])
+    model.eval()
+
+    print("Exporting the encoder and the decoder step to %s" % opt.output)
+
+    with torch.no_grad():
+        export_scripted_model(model, model_opt, dicts, opt.output, quantize=opt.quantize)
+
+    print("Size: %.1f MB -> %.1f MB" % (os.path.getsize(opt.model) / 2 ** 20, os.path.getsize(opt.output) / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -93,7 +93,7 @@ class Beam(object):
 
         # bestScoresId is flattened beam x word array, so calculate which
         # word and beam each score came from
-        prevK = bestScoresId / numWords
+        prevK = bestScoresId // numWords
         self.prevKs.append(prevK)
         self.nextYs.append(bestScoresId - prevK * numWords)
         self.attn.append(attnOut.index_select(0, prevK))
@@ -136,3 +136,160 @@ class Beam(object):
         length = len(hyp)
 
         return hyp[::-1], torch.stack(attn[::-1]), length
+
+
+class BatchedBeam(object):
+    """
+    The beams of all the sentences of a batch, advanced together with batched tensor operations.
+    The search is the same as one Beam per sentence: a sentence is finished when the top of
+    its beam is EOS, and is not advanced anymore.
+
+    The histories are kept for the whole batch: batch_size x size tensors for each time-step,
+    the finished sentences just keep their last values.
+    """
+
+    def __init__(self, batch_size, size, bos_id, cuda=False, sampling=False):
+
+        self.batch_size = batch_size
+        self.size = size
+        self.sampling = sampling
+
+        self.tt = torch.cuda if cuda else torch
+
+        # The score for each translation on the beams (batch_size x size).
+        self.scores = self.tt.FloatTensor(batch_size, size).zero_()
+        self.allScores = []
+
+        # The backpointers at each time-step.
+        self.prevKs = []
+
+        # The outputs at each time-step.
+        self.nextYs = [self.tt.LongTensor(batch_size, size).fill_(onmt.Constants.PAD)]
+        self.nextYs[0][:, 0] = bos_id
+
+        # The attentions (batch_size x size x src_len) for each time.
+        self.attn = []
+
+        # The sentences not finished yet, in the order of the rows of the decoder
+        self.active = list(range(batch_size))
+        self.done = [False] * batch_size
+
+        # Number of time-steps of the finished sentences
+        self.lengths = [0] * batch_size
+
+    def getCurrentState(self):
+        "Get the outputs of the active sentences for the current timestep (n_active x size)."
+        return self.nextYs[-1].index_select(0, self.tt.LongTensor(self.active))
+
+    def getCurrentOrigin(self):
+        "Get the backpointers of the sentences advanced at the last timestep (n_active x size)."
+        return self.origin
+
+    def advance(self, wordLk, attnOut):
+        """
+        Given prob over words for every last beam of the active sentences `wordLk`
+        and attention `attnOut`: Compute and update the beam search.
+
+        Parameters:
+
+        * `wordLk`- probs of advancing from the last step (n_active x K x words)
+        * `attnOut`- attention at the last step (n_active x K x src_len)
+
+        Returns: the positions (in the active sentences) of the sentences which are not finished.
+        """
+        n_active, size, numWords = wordLk.size()
+        active = self.tt.LongTensor(self.active)
+
+        # Sum the previous scores.
+        if len(self.prevKs) > 0:
+            beamLk = wordLk + self.scores.index_select(0, active).unsqueeze(2)
+        else:
+            beamLk = wordLk[:, 0]
+
+        flatBeamLk = beamLk.contiguous().view(n_active, -1)
+
+        if not self.sampling:
+            bestScores, bestScoresId = flatBeamLk.topk(size, 1, True, True)
+        else:
+            # as in Beam, one word is sampled for each beam, and read from the first beam
+            probs = torch.exp(wordLk).view(n_active * size, numWords)
+            bestScoresId = torch.multinomial(probs, 1).view(n_active, size)
+            bestScores = flatBeamLk.gather(1, bestScoresId)
+
+        # bestScoresId is flattened beam x word array, so calculate which
+        # word and beam each score came from
+        prevK = bestScoresId // numWords
+        nextY = bestScoresId - prevK * numWords
+        self.origin = prevK
+
+        self.allScores.append(self.scores)
+        self.scores = self.scores.index_copy(0, active, bestScores)
+
+        self.prevKs.append(self.tt.LongTensor(self.batch_size, size).zero_().index_copy_(0, active, prevK))
+        self.nextYs.append(self.nextYs[-1].index_copy(0, active, nextY))
+
+        attn = attnOut.gather(1, prevK.unsqueeze(2).expand_as(attnOut))
+        self.attn.append(attnOut.new(self.batch_size, size, attnOut.size(2)).zero_().index_copy_(0, active, attn))
+
+        # End condition is when top-of-beam is EOS.
+        finished = nextY[:, 0].eq(onmt.Constants.EOS).tolist()
+        remaining = []
+        for i, b in enumerate(self.active):
+            if finished[i]:
+                self.done[b] = True
+                self.lengths[b] = len(self.prevKs)
+            else:
+                remaining.append(i)
+
+        self.active = [self.active[i] for i in remaining]
+
+        return remaining
+
+    def sortBest(self):
+        return torch.sort(self.scores, 1, True)
+
+    def getHyps(self, ks):
+        """
+        Walk back to construct the full hypotheses of all sentences.
+
+        Parameters.
+
+             * `ks` - batch_size x n LongTensor, the positions in the beams to construct.
+
+         Returns.
+
+            1. The hypotheses: for each sentence, the list of its n token tensors
+            2. The attention at each time step: for each sentence, the list of its n len x src_len tensors
+            3. The lengths: for each sentence, the list of its n lengths
+        """
+        n_steps = len(self.prevKs)
+        lengths = [length if self.done[b] else n_steps for b, length in enumerate(self.lengths)]
+        valid = self.tt.LongTensor(lengths).unsqueeze(1)
+
+        hyp = self.tt.LongTensor(n_steps, self.batch_size, ks.size(1))
+        attn = self.attn[0].new(n_steps, self.batch_size, ks.size(1), self.attn[0].size(2))
+
+        k = ks
+        for j in range(n_steps - 1, -1, -1):
+            hyp[j] = self.nextYs[j + 1].gather(1, k)
+            attn[j] = self.attn[j].gather(1, k.unsqueeze(2).expand(-1, -1, attn.size(3)))
+            # the sentences finished before this step stay on the same hypotheses
+            k = torch.where(valid.gt(j), self.prevKs[j].gather(1, k), k)
+
+        hyps = [[list(hyp[:lengths[b], b, n]) for n in range(ks.size(1))] for b in range(self.batch_size)]
+        attns = [[attn[:lengths[b], b, n] for n in range(ks.size(1))] for b in range(self.batch_size)]
+
+        return hyps, attns, [[lengths[b]] * ks.size(1) for b in range(self.batch_size)]
+
+    def getHistory(self, b):
+        """
+        The back pointers, scores and outputs of sentence `b` at each time-step
+        (the same lists as prevKs, allScores and nextYs of a Beam)
+        """
+        n_steps = self.lengths[b] if self.done[b] else len(self.prevKs)
+
+        prevKs = [t[b] for t in self.prevKs[:n_steps]]
+        allScores = [t[b] for t in self.allScores[:n_steps]] + ([self.scores[b]] if self.done[b] else [])
+        nextYs = [t[b] for t in self.nextYs[:n_steps + 1]]
+
+        return prevKs, allScores, nextYs
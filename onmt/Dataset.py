@@ -1,6 +1,7 @@
 from __future__ import division
 
 import math
+import numpy as np
 import torch
 from collections import defaultdict
 import onmt
@@ -15,8 +16,93 @@ Two basic classes:
 """
 
 
+def sequence_lengths(data):
+    """
+    :param data: list of tensors, IndexedDataset or MMapIndexedDataset
+    :return: numpy array with the length (first dimension) of each sequence
+    """
+    if hasattr(data, 'dim_offsets'):
+        # IndexedDataset: the sizes of all dimensions, one sequence after the other
+        return np.asarray(data.sizes)[data.dim_offsets[:-1]].astype(np.int64)
+
+    if hasattr(data, 'sizes'):
+        return np.asarray(data.sizes, dtype=np.int64)
+
+    return np.array([x.size(0) for x in data], dtype=np.int64)
+
+
+def allocate_batches(lengths, batch_size_sents, batch_size_words, multiplier=1, pad_count=True):
+    """
+    Group consecutive sequences into mini-batches
+    :param lengths: numpy array with the length of each sequence
+    :param batch_size_sents: maximum number of sequences in a batch
+    :param batch_size_words: maximum size of a batch, in tokens (padding included with pad_count)
+    :param multiplier: the size of the batches is cut to a multiple of it (when it is full)
+    :param pad_count: the size of a batch is its number of sequences times the longest one,
+    otherwise the sum of the lengths
+    :return: list of batches, each batch is a list of indices in lengths
+    """
+    batches = []
+
+    # the sentences are added to the current batch [start, i) in order: when sentence i makes
+    # it exceed the maximum size, the batch is cut to fit the multiplier and the rest is carried over.
+    # The size of the batch with each of the next sentences is computed at once
+    # (cumulative maximum or sum), it can have at most batch_size_sents sentences.
+    # The window only covers the sentences that can fit: with positive lengths, a batch has at most
+    # batch_size_words sentences (it grows when more fit, with empty sequences)
+    n_sents = len(lengths)
+    min_window = min(batch_size_sents, batch_size_words) + 1
+    window_size = min_window
+    start, i = 0, 0
+    while i < n_sents:
+        window = lengths[start:min(start + window_size, n_sents)]
+        n_batch = np.arange(len(window))
+
+        oversized = n_batch >= batch_size_sents
+        if not pad_count:
+            oversized |= np.cumsum(window) > batch_size_words
+        else:
+            oversized |= (n_batch > 0) & (np.maximum.accumulate(window) * (n_batch + 1) > batch_size_words)
+
+        # the carried over sentences are already in the batch
+        oversized[:i - start] = False
+        cut = np.flatnonzero(oversized)
+
+        if len(cut) == 0:
+            i = start + len(window)
+            window_size = min(2 * window_size, batch_size_sents + 1)
+            continue
+
+        # cut-off the current list to fit the multiplier
+        current_size = int(cut[0])
+        scaled_size = max(
+            multiplier * (current_size // multiplier),
+            current_size % multiplier)
+
+        batches.append(list(range(start, start + scaled_size)))  # add this batch into the batch list
+
+        start = start + scaled_size
+        i = start + current_size - scaled_size + 1
+        window_size = min_window
+
+    # catch the last batch
+    if start < n_sents:
+        batches.append(list(range(start, n_sents)))
+
+    return batches
+
+
+def _element_size(dtype):
+    return torch.empty(0, dtype=dtype).element_size()
+
+
 class Batch(object):
     # An object to manage the data within a minibatch
+
+    # the tensors packed in one buffer (see pin_memory)
+    packed = None
+    has_target = False
+
     def __init__(self, src_data, tgt_data=None,
                  src_atb_data=None, tgt_atb_data=None,
                  src_type='text',
@@ -102,19 +188,22 @@ class Batch(object):
 
     # down sampling the speech signal by simply concatenating n features (reshaping)
     def downsample(self, data):
-
+        """
+        :param data: batch_size x len x feature_size, padded with zeros
+        :return: batch_size x ceil(len / n) x (feature_size * n)
+        """
         if self.reshape_speech == 0:
             return data
 
         else:
             concat = self.reshape_speech
             tensor_ = data.float()  # adding float because of fp16 data storage
-            add = (concat - tensor_.size()[0] % concat) % concat
-            z = torch.FloatTensor(add, tensor_.size()[1]).zero_()
+            add = (concat - tensor_.size(1) % concat) % concat
 
             # adding an additional dimension as padding
-            tensor_ = torch.cat((tensor_, z), 0)
-            tensor_ = tensor_.reshape((int(tensor_.size()[0] / concat), tensor_.size()[1] * concat))
+            if add > 0:
+                tensor_ = torch.cat((tensor_, tensor_.new_zeros(tensor_.size(0), add, tensor_.size(2))), 1)
+            tensor_ = tensor_.view(tensor_.size(0), tensor_.size(1) // concat, tensor_.size(2) * concat)
 
             return tensor_
 
@@ -122,52 +211,73 @@ class Batch(object):
 
         return
 
+    @staticmethod
+    def _positions(lengths, max_length, align_right=False):
+        """
+        :return: the indices of the positions of the sequences (aligned to the left or right)
+        in the flattened batch_size x max_length tensor, in row major order
+        """
+        positions = torch.arange(max_length).unsqueeze(0)
+        lengths = torch.LongTensor(lengths).unsqueeze(1)
+
+        if align_right:
+            mask = positions >= max_length - lengths
+        else:
+            mask = positions < lengths
+
+        return mask.view(-1).nonzero().squeeze(1)
+
     def collate(self, data, align_right=False, type="text", augmenter=None):
 
         lengths = [x.size(0) for x in data]
         max_length = max(lengths)
         # initialize with batch_size * length first
+        # the sequences are concatenated and copied at once to their positions
         if type == "text":
             tensor = data[0].new(len(data), max_length).fill_(onmt.Constants.PAD)
-            for i in range(len(data)):
-                data_length = data[i].size(0)
-                offset = max_length - data_length if align_right else 0
-                tensor[i].narrow(0, offset, data_length).copy_(data[i])
+            tensor.view(-1).index_copy_(0, self._positions(lengths, max_length, align_right), torch.cat(data))
 
             return tensor, lengths
 
         elif type == "audio":
             # the last feature dimension is for padding or not, hence + 1
 
-            def find_length(x, concat):
+            def find_length(length, concat):
+
+                add = (concat - length % concat) % concat
 
-                add = (concat - x.size(0) % concat) % concat
+                return int((length + add) / concat)
 
-                return int((x.size(0) + add) / concat)
+            if augmenter is not None:
+                data = [augmenter.augment(sample) for sample in data]
 
             if self.reshape_speech >= 1:
-                lengths = [find_length(x, self.reshape_speech) for x in data]
+                lengths = [find_length(x.size(0), self.reshape_speech) for x in data]
+
+            # the samples are padded with zeros (to a multiple of the reshaping) and downsampled together
+            data_lengths = [x.size(0) for x in data]
+            n_frames = max(data_lengths)
+            if self.reshape_speech != 0:
+                n_frames = find_length(n_frames, self.reshape_speech) * self.reshape_speech
+            features = data[0].float().new_zeros(len(data), n_frames, data[0].size(1))
+            features.view(-1, features.size(2)).index_copy_(0, self._positions(data_lengths, n_frames),
+                                                            torch.cat(data).float())
+            features = self.downsample(features)
+
+            if self.reshape_speech != 0:
+                data_lengths = [find_length(length, self.reshape_speech) for length in data_lengths]
+            feature_size = features.size(2)
+            features = features.view(-1, feature_size).index_select(0, self._positions(data_lengths,
+                                                                                       features.size(1)))
+
+            # padding dimension: 1 is not padded, 1 is padded
+            features = torch.cat((features.new_ones(features.size(0), 1), features), 1)
 
             # allocate data for the batch speech
-            feature_size = data[0].size(1) * self.reshape_speech if self.reshape_speech >= 1 else data[0].size(1)
             batch_size = len(data)
-            tensor = data[0].float().new(batch_size, max_length, feature_size + 1).fill_(onmt.Constants.PAD)
-
-            for i in range(len(data)):
-
-                sample = data[i]
-
-                if augmenter is not None:
-                    sample = augmenter.augment(sample)
-
-                feature = self.downsample(sample)
-
-                data_length = feature.size(0)
-                offset = max_length - data_length if align_right else 0
-
-                tensor[i].narrow(0, offset, data_length).narrow(1, 1, feature.size(1)).copy_(feature)
-                # padding dimension: 1 is not padded, 1 is padded
-                tensor[i].narrow(0, offset, data_length).narrow(1, 0, 1).fill_(1)
+            tensor = features.new(batch_size, max_length, feature_size + 1).fill_(onmt.Constants.PAD)
+            tensor.view(-1, feature_size + 1).index_copy_(0, self._positions(data_lengths, max_length, align_right),
+                                                          features)
 
             return tensor, lengths
         else:
@@ -179,17 +289,68 @@ class Batch(object):
         else:
             return None
 
-    def cuda(self, fp16=False):
+    def _pack(self, fp16=False, pin_memory=False):
+        """
+        Copy the tensors into one flat byte buffer (the float tensors in half with fp16),
+        so that they are moved to the GPU with a single transfer.
+        The tensors of the batch become views of the buffer.
+        :return: the buffer and its layout: key, sub key (attributes), type, shape and offset of each tensor
+        """
+        layout = list()
+        size = 0
+
         for key, tensor in self.tensors.items():
-            if isinstance(tensor, dict):
-                for k in tensor:
-                    v = tensor[k]
-                    tensor[k] = v.cuda()
+            # the shifted targets are views of the target
+            if tensor is None or (key in ['target_input', 'target_output'] and self.has_target):
+                continue
+
+            items = tensor.items() if isinstance(tensor, dict) else [(None, tensor)]
+            for sub_key, t in items:
+                dtype = torch.half if fp16 and t.dtype == torch.float else t.dtype
+                size = (size + 7) // 8 * 8  # aligned for any type
+                layout.append((key, sub_key, dtype, t.size(), size))
+                size += t.numel() * _element_size(dtype)
+
+        buffer = torch.empty(size, dtype=torch.uint8, pin_memory=pin_memory)
+        sources = [self.tensors[key] if sub_key is None else self.tensors[key][sub_key]
+                   for key, sub_key, _, _, _ in layout]
+
+        self._unpack(buffer, layout)
+        for (key, sub_key, _, _, _), source in zip(layout, sources):
+            view = self.tensors[key] if sub_key is None else self.tensors[key][sub_key]
+            view.copy_(source)
+
+        return buffer, layout
+
+    def _unpack(self, buffer, layout):
+        """Point the tensors of the batch to their place in the buffer"""
+        for key, sub_key, dtype, shape, offset in layout:
+            n_bytes = shape.numel() * _element_size(dtype)
+            view = buffer[offset:offset + n_bytes].view(dtype).view(shape)
+
+            if sub_key is None:
+                self.tensors[key] = view
             else:
-                if tensor.type() == "torch.FloatTensor" and fp16:
-                    self.tensors[key] = tensor.half()
-                self.tensors[key] = self.tensors[key].cuda()
+                self.tensors[key][sub_key] = view
+
+        if self.has_target:
+            self.tensors['target_input'] = self.tensors['target'][:-1]
+            self.tensors['target_output'] = self.tensors['target'][1:]
+
+    def pin_memory(self, fp16=False):
+        """Pack the tensors into page-locked memory, for an asynchronous copy to the GPU (see cuda)"""
+        self.packed = self._pack(fp16=fp16, pin_memory=True) + (fp16,)
+
+        return self
 
+    def cuda(self, fp16=False, non_blocking=False):
+        # one transfer of all tensors, packed beforehand in pinned memory (pin_memory) or here
+        if self.packed is None or self.packed[2] != fp16:
+            self.packed = self._pack(fp16=fp16) + (fp16,)
+
+        buffer, layout, _ = self.packed
+        self._unpack(buffer.cuda(non_blocking=non_blocking), layout)
+        self.packed = None
 
 class Dataset(object):
 
@@ -214,6 +375,10 @@ class Dataset(object):
         self.tgt_atbs = tgt_atbs
         self.fullSize = len(self.src) if self.src is not None else len(self.tgt)
 
+        # lengths of the sequences (from the index of the binary datasets, without reading the data)
+        self.src_sizes = sequence_lengths(self.src) if self.src is not None else None
+        self.tgt_sizes = sequence_lengths(self.tgt) if self.tgt is not None else None
+
         # maximum number of tokens in a mb
         self.batch_size_words = batch_size_words
 
@@ -249,66 +414,18 @@ class Dataset(object):
     # This function allocates the mini-batches (grouping sentences with the same size)
     def allocate_batch(self):
 
-        cur_batch = []
-        cur_batch_size = 0
-        cur_batch_sizes = []
-        
-        def oversize_(cur_batch, sent_size):
-
-            if len(cur_batch) >= self.batch_size_sents:
-                return True
-
-            if not self.pad_count:
-                if cur_batch_size + sent_size > self.batch_size_words:
-                    return True
-            else:
-                if len(cur_batch_sizes) == 0:
-                    return False
-
-                if (max(max(cur_batch_sizes), sent_size)) * (len(cur_batch)+1) > self.batch_size_words:
-                    return True
-            return False
+        if self.tgt is not None and self.src is not None:
+            lengths = np.maximum(self.tgt_sizes - 1, self.src_sizes)
+        elif self.tgt is not None:
+            lengths = self.tgt_sizes - 1
+        else:
+            lengths = self.src_sizes
 
-        i = 0
-        while i < self.fullSize:
+        self.batches = allocate_batches(lengths, self.batch_size_sents, self.batch_size_words,
+                                        multiplier=self.multiplier, pad_count=self.pad_count)
 
-            if self.tgt is not None and self.src is not None:
-                sentence_length = max(self.tgt[i].size(0) - 1, self.src[i].size(0))
-                # print(sentence_length)
-            elif self.tgt is not None:
-                sentence_length = self.tgt[i].size(0) - 1
-            else:
-                sentence_length = self.src[i].size(0)
-
-            oversized = oversize_(cur_batch, sentence_length)
-            # if the current item makes the batch exceed max size
-            # then we create a new batch
-            if oversized:
-                # cut-off the current list to fit the multiplier
-                current_size = len(cur_batch)
-                scaled_size = max(
-                    self.multiplier * (current_size // self.multiplier),
-                    current_size % self.multiplier)
-
-                batch_ = cur_batch[:scaled_size]
-                self.batches.append(batch_)  # add this batch into the batch list
-
-                cur_batch = cur_batch[scaled_size:]  # reset the current batch
-                cur_batch_sizes = cur_batch_sizes[scaled_size:]
-                cur_batch_size = sum(cur_batch_sizes)
-
-            cur_batch.append(i)
-            cur_batch_size += sentence_length
-            cur_batch_sizes.append(sentence_length)
-
-            i = i + 1
-            
-        # catch the last batch
-        if len(cur_batch) > 0:
-            self.batches.append(cur_batch)
-        
         self.num_batches = len(self.batches)
-                
+
     def __getitem__(self, index, src_align_right=False, tgt_align_right=False):
         """
         :param index: the index of the mini-batch in the list
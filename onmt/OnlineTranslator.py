@@ -1,11 +1,16 @@
+import torch
 import onmt
 import onmt.modules
+from onmt.inference.Options import decoding_defaults
 
 
 class TranslatorParameter(object):
 
     def __init__(self, filename):
 
+        # the defaults of translate.py for the decoding options, and of the online setting for the others
+        self.__dict__.update(vars(decoding_defaults()))
+
         self.model = "";
         self.src = "<stdin>";
         self.src_img_dir = "";
@@ -14,24 +19,31 @@ class TranslatorParameter(object):
         self.beam_size = 1
         self.batch_size = 1
         self.max_sent_length = 100
-        self.dump_beam = ""
-        self.n_best = self.beam_size
-        self.replace_unk = False
-        self.gpu = -1;
         self.cuda = 0;
-        self.verbose = False
 
-        self.beta=0.0
         self.alpha=0.0
         self.start_with_bos=True
-        self.fp16=False
-        self.ensemble_op='mean'
-        self.autoencoder=None
-        self.encoder_type='text'
-        
-        self.read_file(filename)
+        self.fast_translate=True
+
+        # number of dummy decodes at startup (0 to disable)
+        self.warmup=1
+        self.warmup_length=32
+
+        options = self.read_file(filename)
+
+        self.cuda = self.gpu > -1
+
+        # all the hypotheses of the beam, unless the config file sets n_best
+        if 'n_best' not in options:
+            self.n_best = self.beam_size
 
     def read_file(self,filename):
+        """
+        Read the options from the config file: one "option value" pair per line.
+        The value is converted to the type of the default value of the option.
+        :return: the names of the options set in the file
+        """
+        options = set()
 
         f = open(filename)
 
@@ -41,23 +53,75 @@ class TranslatorParameter(object):
 
             w = line.strip().split()
 
-            if w[0] == "model":
-                self.model = w[1]
-            elif w[0] == "beam_size":
-                self.beam_size = int(w[1])
+            if len(w) == 0 or w[0].startswith('#'):
+                line = f.readline()
+                continue
+
+            name, value = w[0], " ".join(w[1:])
+
+            if not hasattr(self, name):
+                print("* Unknown option in %s: %s" % (filename, name))
+            else:
+                default = getattr(self, name)
+
+                if isinstance(default, bool):
+                    value = value.lower() in ['1', 'true', 'yes']
+                elif isinstance(default, int):
+                    value = int(value)
+                elif isinstance(default, float):
+                    value = float(value)
+
+                setattr(self, name, value)
+                options.add(name)
 
             line = f.readline()
 
+        f.close()
+
+        return options
+
 
 class OnlineTranslator(object):
     def __init__(self, model):
         opt = TranslatorParameter(model)
-        self.translator = onmt.EnsembleTranslator(opt)
-    
-
-    def translate(self,input):
-        predBatch, predScore, predLength, goldScore, numGoldWords,allGoldScores = self.translator.translate([input.split()],[])
+        self.opt = opt
+
+        if opt.cuda:
+            torch.cuda.set_device(opt.gpu)
+
+        if opt.fast_translate:
+            from onmt.inference.FastTranslator import FastTranslator
+            self.translator = FastTranslator(opt)
+        else:
+            self.translator = onmt.Translator(opt)
+
+        self.warm_up()
+
+    def warm_up(self):
+        """
+        Run dummy decodes on a full batch, so that the first real request does not pay
+        for the lazy initialization of the kernels and for growing the memory allocator pools
+        """
+        if self.opt.warmup <= 0 or self.opt.encoder_type != 'text':
+            return
+
+        dummy_batch = [[onmt.Constants.UNK_WORD] * self.opt.warmup_length for _ in range(self.opt.batch_size)]
+
+        for _ in range(self.opt.warmup):
+            self.translator.translate(dummy_batch, [])
+
+        if self.opt.cuda:
+            torch.cuda.synchronize()
+
+    def translate(self,input,prefix=None):
+        """
+        :param input: source sentence
+        :param prefix: optional beginning of the translation, which is kept and continued (fast_translate only)
+        """
+        if prefix:
+            predBatch, predScore, predLength, goldScore, numGoldWords,allGoldScores = \
+                self.translator.translate([input.split()],[],prefix_data=[prefix.split()])
+        else:
+            predBatch, predScore, predLength, goldScore, numGoldWords,allGoldScores = self.translator.translate([input.split()],[])
 
         return " ".join(predBatch[0][0])
-  
-
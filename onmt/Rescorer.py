@@ -5,6 +5,8 @@ import torch
 import math
 from onmt.ModelConstructor import build_model, build_language_model
 from ae.Autoencoder import Autoencoder
+from onmt.inference.EncoderCache import EncoderCache
+from onmt.inference.Release import load_checkpoint, share_weights
 import torch.nn.functional as F
 import sys
 
@@ -24,6 +26,9 @@ class Rescorer(object):
         self.bos_token = opt.bos_token
         self.sampling = opt.sampling
 
+        # number of distinct source sentences whose encoder outputs are kept (0 to disable)
+        self.encoder_cache = EncoderCache(opt.encoder_cache_size)
+
         if self.attributes:
             self.attributes = self.attributes.split("|")
 
@@ -40,8 +45,7 @@ class Rescorer(object):
         for i, model in enumerate(models):
             if opt.verbose:
                 print('Loading model from %s' % model)
-            checkpoint = torch.load(model,
-                                    map_location=lambda storage, loc: storage)
+            checkpoint = load_checkpoint(model)
 
             model_opt = checkpoint['opt']
 
@@ -67,7 +71,10 @@ class Rescorer(object):
             # else:
             #     model = build_model(model_opt, checkpoint['dicts'])
             model = build_model(model_opt, checkpoint['dicts'])
-            model.load_state_dict(checkpoint['model'])
+            if 'release' in checkpoint:
+                share_weights(model, checkpoint['model'])
+            else:
+                model.load_state_dict(checkpoint['model'])
 
             if model_opt.model in model_list:
                 # if model.decoder.positional_encoder.len_max < self.opt.max_sent_length:
@@ -292,7 +299,9 @@ class Rescorer(object):
             # Use the first model to decode
             model_ = self.models[0]
 
-            gold_words, gold_scores, allgold_scores = model_.decode(batch)
+            # the n-best hypotheses of one source share its encoder output
+            encoder_output = self.encoder_cache.encode(model_, batch)
+            gold_words, gold_scores, allgold_scores = model_.decode(batch, encoder_output=encoder_output)
 
         torch.set_grad_enabled(True)
 
@@ -5,8 +5,13 @@ import torch
 import math
 from onmt.ModelConstructor import build_model, build_language_model
 from ae.Autoencoder import Autoencoder
+from onmt.inference.EncoderCache import EncoderCache
+from onmt.inference.EnsembleWorkers import EnsembleWorkers
+from onmt.inference.Ensemble import EnsembleCombiner
+from onmt.inference.Quantization import quantize_model
+from onmt.inference.Scripted import is_scripted_model, load_scripted_model
+from onmt.inference.Release import load_checkpoint, share_weights
 import torch.nn.functional as F
-import sys
 
 model_list = ['transformer', 'stochastic_transformer', 'fusion_network']
 
@@ -24,6 +29,15 @@ class Translator(object):
         self.bos_token = opt.bos_token
         self.sampling = opt.sampling
 
+        # maximum number of source tokens times beam size in a mini-batch
+        self.batch_size_words = opt.batch_size_words
+
+        # number of distinct source sentences whose encoder outputs are kept (0 to disable)
+        self.encoder_cache = EncoderCache(opt.encoder_cache_size)
+
+        # dynamic quantization of the models for CPU decoding (int8)
+        self.quantize = opt.quantize
+
         if self.attributes:
             self.attributes = self.attributes.split("|")
 
@@ -40,8 +54,12 @@ class Translator(object):
         for i, model in enumerate(models):
             if opt.verbose:
                 print('Loading model from %s' % model)
-            checkpoint = torch.load(model,
-                                    map_location=lambda storage, loc: storage)
+            # TorchScript archive saved by export_torchscript.py: the model is not rebuilt
+            scripted = is_scripted_model(model)
+            if scripted:
+                model, checkpoint = load_scripted_model(model)
+            else:
+                checkpoint = load_checkpoint(model)
 
             model_opt = checkpoint['opt']
 
@@ -66,8 +84,23 @@ class Translator(object):
             #     model = build_fusion(model_opt, checkpoint['dicts'])
             # else:
             #     model = build_model(model_opt, checkpoint['dicts'])
-            model = build_model(model_opt, checkpoint['dicts'])
-            model.load_state_dict(checkpoint['model'])
+            # a quantized checkpoint (saved by quantize.py) is loaded into the quantized model
+            quantize = checkpoint['quantize'] if 'quantize' in checkpoint else None
+
+            if scripted:
+                if self.quantize and not quantize:
+                    raise ValueError('TorchScript models are quantized when exported (export_torchscript.py -quantize)')
+            else:
+                model = build_model(model_opt, checkpoint['dicts'])
+
+                if quantize:
+                    model = quantize_model(model, quantize)
+
+                if 'release' in checkpoint:
+                    # the weights stay in the memory mapped file (release_model.py)
+                    share_weights(model, checkpoint['model'])
+                else:
+                    model.load_state_dict(checkpoint['model'])
 
             if model_opt.model in model_list:
                 # if model.decoder.positional_encoder.len_max < self.opt.max_sent_length:
@@ -75,6 +108,12 @@ class Translator(object):
                 #     model.decoder.renew_buffer(self.opt.max_sent_length)
                 model.renew_buffer(self.opt.max_sent_length)
 
+            if self.quantize and not quantize:
+                model = quantize_model(model, self.quantize)
+
+            if (quantize or self.quantize) and (opt.cuda or opt.fp16):
+                raise ValueError('Quantized models can only be used on CPU, without -fp16')
+
             if opt.fp16:
                 model = model.half()
 
@@ -112,6 +151,20 @@ class Translator(object):
         self.cuda = opt.cuda
         self.ensemble_op = opt.ensemble_op
 
+        # weights of the models separated by |, uniform if not given
+        ensemble_weights = None
+        if opt.ensemble_weights:
+            ensemble_weights = [float(w) for w in opt.ensemble_weights.split("|")]
+            if len(ensemble_weights) != self.n_models:
+                raise ValueError('%d ensemble weights given for %d models' % (len(ensemble_weights), self.n_models))
+        self.combiner = EnsembleCombiner(self.ensemble_op, ensemble_weights)
+
+        # run the decoding steps of the ensemble members in parallel threads
+        if self.n_models > 1 and opt.ensemble_workers:
+            self.ensemble_workers = EnsembleWorkers(self.n_models, opt.ensemble_threads)
+        else:
+            self.ensemble_workers = None
+
         if opt.autoencoder is not None:
             if opt.verbose:
                 print('Loading autoencoder from %s' % opt.autoencoder)
@@ -149,59 +202,17 @@ class Translator(object):
     # Combine distributions from different models
     def _combine_outputs(self, outputs):
 
-        if len(outputs) == 1:
-            return outputs[0]
-
-        if self.ensemble_op == "logSum":
-            output = (outputs[0])
-
-            # sum the log prob
-            for i in range(1, len(outputs)):
-                output += (outputs[i])
-
-            output.div_(len(outputs))
-
-            # output = torch.log(output)
-            output = F.log_softmax(output, dim=-1)
-        elif self.ensemble_op == "mean":
-            output = torch.exp(outputs[0])
-
-            # sum the log prob
-            for i in range(1, len(outputs)):
-                output += torch.exp(outputs[i])
-
-            output.div_(len(outputs))
-            # output = torch.log(output)
-            output = torch.log(output)
-        elif self.ensemble_op == "max":
-            output = outputs[0]
-
-            for i in range(1, len(outputs)):
-                output = torch.max(output,outputs[i])
-
-        elif self.ensemble_op == "min":
-            output = outputs[0]
-
-            for i in range(1, len(outputs)):
-                output = torch.min(output,outputs[i])
-
-        elif self.ensemble_op == 'gmean':
-            output = torch.exp(outputs[0])
+        return self.combiner(outputs)
 
-            # geometric mean of the probabilities
-            for i in range(1, len(outputs)):
-                output *= torch.exp(outputs[i])
+    def _run_models(self, fn):
+        """
+        :param fn: function of the model index (e.g. one decoding step of that model)
+        :return: dictionary of the outputs of fn for all models, run in the ensemble workers if any
+        """
+        if self.ensemble_workers is None:
+            return {i: fn(i) for i in range(self.n_models)}
 
-            # have to normalize
-            output.pow_(1.0 / float(len(outputs)))
-            norm_ = torch.norm(output, p=1, dim=-1)
-            output.div_(norm_.unsqueeze(-1))
-
-            output = torch.log(output)
-        else:
-            raise ValueError(
-                'Emsemble operator needs to be "mean" or "logSum", the current value is %s' % self.ensemble_op)
-        return output
+        return dict(enumerate(self.ensemble_workers.map(fn)))
 
     # Take the average of attention scores
     def _combine_attention(self, attns):
@@ -260,7 +271,7 @@ class Translator(object):
 
         return onmt.Dataset(src_data, tgt_data,
                             src_atbs=src_atbs, tgt_atbs=tgt_atbs,
-                            batch_size_words=sys.maxsize,
+                            batch_size_words=max(self.batch_size_words // self.opt.beam_size, 1),
                             data_type=self._type,
                             batch_size_sents=self.opt.batch_size)
 
@@ -275,9 +286,37 @@ class Translator(object):
                                                    onmt.Constants.EOS_WORD) for b in tgt_sents]
 
         return onmt.Dataset(src_data, tgt_data,
-                            batch_size_words=sys.maxsize,
+                            batch_size_words=max(self.batch_size_words // self.opt.beam_size, 1),
                             data_type=self._type, batch_size_sents=self.opt.batch_size)
 
+    def translate_dataset(self, dataset, translate_fn):
+        """
+        Run the translation function on every mini-batch of the dataset and concatenate the outputs
+        :param dataset: onmt.Dataset built from the sentences (the batches follow the input order)
+        :param translate_fn: function taking a Batch and returning a tuple of lists, tensors or counts
+        :return: the outputs of all mini-batches (lists and tensors concatenated, counts summed)
+        """
+        outputs = None
+
+        for i in range(dataset.num_batches):
+            batch = dataset.next()[0]
+            if self.cuda:
+                batch.cuda(fp16=self.fp16)
+
+            batch_outputs = list(translate_fn(batch))
+
+            if outputs is None:
+                outputs = batch_outputs
+                continue
+
+            for j, output in enumerate(batch_outputs):
+                if torch.is_tensor(output):
+                    outputs[j] = torch.cat([outputs[j], output])
+                else:
+                    outputs[j] = outputs[j] + output
+
+        return outputs
+
     def build_target_tokens(self, pred, src, attn):
         tokens = self.tgt_dict.convertToLabels(pred, onmt.Constants.EOS)
         tokens = tokens[:-1]  # EOS
@@ -296,26 +335,29 @@ class Translator(object):
         gold_words = 0
         allgold_scores = []
 
+        # run the encoders once, the outputs are shared by the gold scoring and the search
+        encoder_outputs = [self.encoder_cache.encode(model, batch, model_id=i) for i, model in enumerate(self.models)]
+
         if batch.has_target:
             # Use the first model to decode
             model_ = self.models[0]
 
-            gold_words, gold_scores, allgold_scores = model_.decode(batch)
+            gold_words, gold_scores, allgold_scores = model_.decode(batch, encoder_output=encoder_outputs[0])
 
         #  (3) Start decoding
 
         # time x batch * beam
 
-        # initialize the beam
-        beam = [onmt.Beam(beam_size, self.bos_id, self.opt.cuda, self.opt.sampling) for k in range(batch_size)]
+        # initialize the beams of all sentences
+        beam = onmt.BatchedBeam(batch_size, beam_size, self.bos_id, self.opt.cuda, self.opt.sampling)
 
-        batch_idx = list(range(batch_size))
         remaining_sents = batch_size
 
         decoder_states = dict()
 
         for i in range(self.n_models):
-            decoder_states[i] = self.models[i].create_decoder_state(batch, beam_size)
+            decoder_states[i] = self.models[i].create_decoder_state(batch, beam_size,
+                                                                    encoder_output=encoder_outputs[i])
 
         if self.opt.lm:
             lm_decoder_states = self.lm_model.create_decoder_state(batch, beam_size)
@@ -324,8 +366,7 @@ class Translator(object):
             # Prepare decoder input.
 
             # input size: 1 x ( batch * beam )
-            input = torch.stack([b.getCurrentState() for b in beam
-                                 if not b.done]).t().contiguous().view(1, -1)
+            input = beam.getCurrentState().t().contiguous().view(1, -1)
 
             decoder_input = input
 
@@ -333,15 +374,13 @@ class Translator(object):
             outs = dict()
             attns = dict()
 
-            for k in range(self.n_models):
-                # decoder_hidden, coverage = self.models[k].decoder.step(decoder_input.clone(), decoder_states[k])
-
-                # run decoding on the model
-                decoder_output = self.models[k].step(decoder_input.clone(), decoder_states[k])
+            # run decoding on the models
+            decoder_outputs = self._run_models(lambda k: self.models[k].step(decoder_input.clone(), decoder_states[k]))
 
+            for k in range(self.n_models):
                 # extract the required tensors from the output (a dictionary)
-                outs[k] = decoder_output['log_prob']
-                attns[k] = decoder_output['coverage']
+                outs[k] = decoder_outputs[k]['log_prob']
+                attns[k] = decoder_outputs[k]['coverage']
 
             # for ensembling models
             out = self._combine_outputs(outs)
@@ -361,50 +400,41 @@ class Translator(object):
             attn = attn.view(beam_size, remaining_sents, -1) \
                 .transpose(0, 1).contiguous()
 
-            active = []
+            # advance the beams of all remaining sentences, and reorder their states
+            active = beam.advance(word_lk.data, attn.data)
 
-            for b in range(batch_size):
-                if beam[b].done:
-                    continue
-
-                idx = batch_idx[b]
-                if not beam[b].advance(word_lk.data[idx], attn.data[idx]):
-                    active += [b]
-
-                for j in range(self.n_models):
-                    decoder_states[j].update_beam(beam, b, remaining_sents, idx)
+            for j in range(self.n_models):
+                decoder_states[j].update_beams(beam.getCurrentOrigin(), remaining_sents)
 
-                if self.opt.lm:
-                    lm_decoder_states.update_beam(beam, b, remaining_sents, idx)
+            if self.opt.lm:
+                lm_decoder_states.update_beams(beam.getCurrentOrigin(), remaining_sents)
 
             if not active:
                 break
 
             # in this section, the sentences that are still active are
             # compacted so that the decoder is not run on completed sentences
-            active_idx = self.tt.LongTensor([batch_idx[k] for k in active])
-            batch_idx = {beam: idx for idx, beam in enumerate(active)}
+            if len(active) < remaining_sents:
+                active_idx = self.tt.LongTensor(active)
 
-            for j in range(self.n_models):
-                decoder_states[j].prune_complete_beam(active_idx, remaining_sents)
+                for j in range(self.n_models):
+                    decoder_states[j].prune_complete_beam(active_idx, remaining_sents)
 
-            if self.opt.lm:
-                lm_decoder_states.prune_complete_beam(active_idx, remaining_sents)
+                if self.opt.lm:
+                    lm_decoder_states.prune_complete_beam(active_idx, remaining_sents)
 
             remaining_sents = len(active)
 
         #  (4) package everything up
         all_hyp, all_scores, all_attn = [], [], []
         n_best = self.opt.n_best
-        all_lengths = []
 
-        for b in range(batch_size):
-            scores, ks = beam[b].sortBest()
+        scores, ks = beam.sortBest()
+        hyps, attns, all_lengths = beam.getHyps(ks[:, :n_best])
 
-            all_scores += [scores[:n_best]]
-            hyps, attn, length = zip(*[beam[b].getHyp(k) for k in ks[:n_best]])
-            all_hyp += [hyps]
-            all_lengths += [length]
+        for b in range(batch_size):
+            all_scores += [scores[b, :n_best]]
+            all_hyp += [hyps[b]]
             # if(src_data.data.dim() == 3):
             if self.opt.encoder_type == 'audio':
                 valid_attn = decoder_states[0].original_src.narrow(2, 0, 1).squeeze(2)[:, b].ne(onmt.Constants.PAD) \
@@ -412,20 +442,21 @@ class Translator(object):
             else:
                 valid_attn = decoder_states[0].original_src[:, b].ne(onmt.Constants.PAD) \
                     .nonzero().squeeze(1)
-            attn = [a.index_select(1, valid_attn) for a in attn]
+            attn = [a.index_select(1, valid_attn) for a in attns[b]]
             all_attn += [attn]
 
             if self.beam_accum:
+                prev_ks, beam_scores, next_ys = beam.getHistory(b)
                 self.beam_accum["beam_parent_ids"].append(
                     [t.tolist()
-                     for t in beam[b].prevKs])
+                     for t in prev_ks])
                 self.beam_accum["scores"].append([
                                                      ["%4f" % s for s in t.tolist()]
-                                                     for t in beam[b].all_scores][1:])
+                                                     for t in beam_scores][1:])
                 self.beam_accum["predicted_ids"].append(
                     [[self.tgt_dict.getLabel(id)
                       for id in t.tolist()]
-                     for t in beam[b].nextYs][1:])
+                     for t in next_ys][1:])
 
         torch.set_grad_enabled(True)
 
@@ -434,13 +465,11 @@ class Translator(object):
     def translate(self, src_data, tgt_data):
         #  (1) convert words to indexes
         dataset = self.build_data(src_data, tgt_data)
-        batch = dataset.next()[0]
-        if self.cuda:
-            batch.cuda(fp16=self.fp16)
-        batch_size = batch.size
+        batch_size = len(src_data)
 
         #  (2) translate
-        pred, pred_score, attn, pred_length, gold_score, gold_words, allgold_words = self.translate_batch(batch)
+        pred, pred_score, attn, pred_length, gold_score, gold_words, allgold_words = \
+            self.translate_dataset(dataset, self.translate_batch)
 
         #  (3) convert indexes to words
         pred_batch = []
@@ -455,14 +484,11 @@ class Translator(object):
     def translate_asr(self, src_data, tgt_data):
         #  (1) convert words to indexes
         dataset = self.build_asr_data(src_data, tgt_data)
-        # src, tgt = batch
-        batch = dataset.next()[0]
-        if self.cuda:
-            batch.cuda(fp16=self.fp16)
-        batch_size = batch.size
+        batch_size = len(src_data)
 
         #  (2) translate
-        pred, pred_score, attn, pred_length, gold_score, gold_words, allgold_words = self.translate_batch(batch)
+        pred, pred_score, attn, pred_length, gold_score, gold_words, allgold_words = \
+            self.translate_dataset(dataset, self.translate_batch)
 
         #  (3) convert indexes to words
         pred_batch = []
@@ -5,10 +5,10 @@ from onmt.OnlineTranslator import OnlineTranslator
 from onmt.Dataset import Dataset
 from onmt.Optim import Optim
 from onmt.Dict import Dict
-from onmt.Beam import Beam
+from onmt.Beam import Beam, BatchedBeam
 from onmt.data_utils.Tokenizer import Tokenizer
 
 import onmt.multiprocessing
 
 # For flake8 compatibility.
-__all__ = [onmt.Constants, Translator, Rescorer, OnlineTranslator, Dataset, Optim, Dict, Beam, Tokenizer]
+__all__ = [onmt.Constants, Translator, Rescorer, OnlineTranslator, Dataset, Optim, Dict, Beam, BatchedBeam, Tokenizer]
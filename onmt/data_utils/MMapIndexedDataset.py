@@ -1,4 +1,5 @@
 import os
+import shutil
 import struct
 
 import numpy as np
@@ -22,9 +23,11 @@ dtypes = {
     3: np.int16,
     4: np.int32,
     5: np.int64,
-    6: np.float,
+    6: np.float64,
     7: np.double,
-    8: np.uint16
+    8: np.uint16,
+    9: np.float32,
+    10: np.float16
 }
 
 
@@ -47,24 +50,35 @@ def _warmup_mmap_file(path):
             pass
 
 class MMapIndexedDataset(torch.utils.data.Dataset):
+    """
+    Sequences stored one after the other in a binary file mapped in memory, with an index file
+    (sizes and pointers). The items are 1-D (text: the size is the number of tokens) or
+    2-D with the same feature size for all of them (speech features: the size is the number of frames).
+    """
     class Index(object):
         _HDR_MAGIC = b'MMIDIDX\x00\x00'
 
         @classmethod
-        def writer(cls, path, dtype):
+        def writer(cls, path, dtype, feature_size=None):
+            """
+            :param feature_size: size of the second dimension of 2-D items (version 2 of the index),
+            None for 1-D items (version 1)
+            """
             class _Writer(object):
                 def __enter__(self):
                     self._file = open(path, 'wb')
 
                     self._file.write(cls._HDR_MAGIC)
-                    self._file.write(struct.pack('<Q', 1))
+                    self._file.write(struct.pack('<Q', 1 if feature_size is None else 2))
                     self._file.write(struct.pack('<B', code(dtype)))
+                    if feature_size is not None:
+                        self._file.write(struct.pack('<Q', feature_size))
 
                     return self
 
                 @staticmethod
                 def _get_pointers(sizes):
-                    dtype_size = dtype().itemsize
+                    dtype_size = dtype().itemsize * (feature_size if feature_size is not None else 1)
                     address = 0
                     pointers = []
 
@@ -101,12 +115,15 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                     'Make sure that --dataset-impl is configured properly.'
                 )
                 version = struct.unpack('<Q', stream.read(8))
-                assert (1,) == version
+                assert version in [(1,), (2,)]
 
                 dtype_code, = struct.unpack('<B', stream.read(1))
                 self._dtype = dtypes[dtype_code]
                 self._dtype_size = self._dtype().itemsize
 
+                # the items of version 2 are matrices: their sizes are the numbers of rows
+                self._feature_size = struct.unpack('<Q', stream.read(8))[0] if version == (2,) else None
+
                 self._len = struct.unpack('<Q', stream.read(8))[0]
                 offset = stream.tell()
 
@@ -131,6 +148,10 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         def sizes(self):
             return self._sizes
 
+        @property
+        def feature_size(self):
+            return self._feature_size
+
         @lru_cache(maxsize=8)
         def __getitem__(self, i):
             return self._pointers[i], self._sizes[i]
@@ -172,6 +193,14 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
     @lru_cache(maxsize=8)
     def __getitem__(self, i):
         ptr, size = self._index[i]
+        feature_size = self._index.feature_size
+
+        if feature_size is not None:
+            # features (fp16 or fp32), copied out of the mapped file
+            np_array = np.frombuffer(self._bin_buffer, dtype=self._index.dtype, count=size * feature_size,
+                                     offset=ptr)
+            return torch.from_numpy(np_array.reshape(size, feature_size).copy())
+
         np_array = np.frombuffer(self._bin_buffer, dtype=self._index.dtype, count=size, offset=ptr)
         if self._index.dtype != np.int64:
             np_array = np_array.astype(np.int64)
@@ -198,16 +227,31 @@ class MMapIndexedDatasetBuilder(object):
         self._data_file = open(out_file, 'wb')
         self._dtype = dtype
         self._sizes = []
+        # feature size of 2-D items (speech features), None for 1-D items
+        self._feature_size = None
 
     def add_item(self, tensor):
         np_array = np.array(tensor.numpy(), dtype=self._dtype)
+
+        if np_array.ndim == 2:
+            if len(self._sizes) == 0:
+                self._feature_size = np_array.shape[1]
+            assert self._feature_size == np_array.shape[1], \
+                "The items need to have the same feature size (%d, %d)" % (self._feature_size, np_array.shape[1])
+            size = np_array.shape[0]
+        else:
+            assert self._feature_size is None, "The items need to have the same number of dimensions"
+            size = np_array.size
+
         self._data_file.write(np_array.tobytes(order='C'))
-        self._sizes.append(np_array.size)
+        self._sizes.append(size)
 
     def merge_file_(self, another_file):
         # Concatenate index
         index = MMapIndexedDataset.Index(index_file_path(another_file))
         assert index.dtype == self._dtype
+        assert len(self._sizes) == 0 or index.feature_size == self._feature_size
+        self._feature_size = index.feature_size
 
         for size in index.sizes:
             self._sizes.append(size)
@@ -219,5 +263,5 @@ class MMapIndexedDatasetBuilder(object):
     def finalize(self, index_file):
         self._data_file.close()
 
-        with MMapIndexedDataset.Index.writer(index_file, self._dtype) as index:
+        with MMapIndexedDataset.Index.writer(index_file, self._dtype, feature_size=self._feature_size) as index:
             index.write(self._sizes)
\ No newline at end of file
@@ -0,0 +1,79 @@
+import queue
+import threading
+
+
+class BatchPrefetcher(object):
+    """
+    Build the next mini-batches of a dataset in a background thread, a bounded number of steps ahead,
+    so that the collation (and the speech augmentation) overlap with the training step.
+
+    The batches are taken with data.next() in the same order as the synchronous loop:
+    the dataset is positioned beforehand (create_order / set_index) and the iterator then yields
+    n_batches batches from there, so a resumed epoch starts on the same batch.
+    With pin_memory, the tensors of the batches are packed in page-locked memory
+    (in half precision with fp16), so that Batch.cuda copies them with one asynchronous transfer.
+    """
+
+    def __init__(self, data, n_batches, curriculum=False, prefetch=2, pin_memory=False, fp16=False):
+        """
+        :param data: Dataset (its iterator is advanced by the background thread)
+        :param n_batches: number of batches to take
+        :param curriculum: argument of data.next()
+        :param prefetch: maximum number of batches built in advance
+        :param pin_memory: pin the memory of the batches
+        :param fp16: the float tensors are packed in half precision
+        """
+        self.data = data
+        self.n_batches = n_batches
+        self.curriculum = curriculum
+        self.pin_memory = pin_memory
+        self.fp16 = fp16
+
+        self.queue = queue.Queue(maxsize=max(prefetch, 1))
+        self.stopped = threading.Event()
+
+        self.thread = threading.Thread(target=self._build_batches, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # give up when the consumer has stopped, instead of blocking on a full queue
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _build_batches(self):
+        try:
+            for _ in range(self.n_batches):
+                batch = self.data.next(curriculum=self.curriculum)[0]
+
+                if self.pin_memory:
+                    batch.pin_memory(fp16=self.fp16)
+
+                if not self._put((batch, None)):
+                    return
+        except Exception as e:
+            # raised again in the training loop
+            self._put((None, e))
+
+    def __len__(self):
+        return self.n_batches
+
+    def __iter__(self):
+        try:
+            for _ in range(self.n_batches):
+                batch, error = self.queue.get()
+
+                if error is not None:
+                    raise error
+
+                yield batch
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped.set()
@@ -0,0 +1,86 @@
+from collections import OrderedDict
+import torch
+from torch.nn.utils.rnn import pad_sequence
+import onmt
+
+
+class EncoderCache(object):
+    """
+    Run the encoder of a model on a batch, reusing the contexts of the sources seen before.
+    The contexts of the last `capacity` distinct sources are kept (least recently used first out),
+    keyed on the model index and the source token ids. A source repeated inside one batch
+    (such as the n-best lists in rescore.py) is also encoded only once.
+
+    With capacity 0 nothing is stored and the encoder simply runs on the whole batch.
+
+    Only text sources are cached, and only for encoders returning a padding mask:
+    otherwise the context of one sentence depends on the padding of the batch.
+    """
+
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.unmasked = set()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def encode(self, model, batch, model_id=0):
+        """
+        :param model: translation model (needs an encode function)
+        :param batch: Batch object
+        :param model_id: index of the model in the ensemble
+        :return: the encoder output {'context': len_src x batch_size x d_model, 'src_mask': batch_size x 1 x len_src}
+                 or None if the model does not take a precomputed encoder output
+        """
+        if not hasattr(model, 'encode'):
+            return None
+
+        src = batch.get('source')
+
+        if self.capacity <= 0 or src.dim() != 2 or model_id in self.unmasked:
+            return model.encode(src)
+
+        sentences = [[w for w in sent if w != onmt.Constants.PAD] for sent in src.t().tolist()]
+        keys = [(model_id, tuple(sent)) for sent in sentences]
+
+        contexts = dict()
+        for key in keys:
+            if key in self.entries and key not in contexts:
+                contexts[key] = self.entries[key]
+                self.entries.move_to_end(key)
+
+        # encode the missing sources (once each), padded to their own maximum length
+        missing, seen = list(), set(contexts)
+        for b, key in enumerate(keys):
+            if key not in seen:
+                seen.add(key)
+                missing.append(b)
+
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+
+        if len(missing) > 0:
+            missing_idx = torch.LongTensor(missing).to(src.device)
+            missing_len = max(len(sentences[b]) for b in missing)
+            encoder_output = model.encode(src.index_select(1, missing_idx)[:missing_len])
+
+            if encoder_output['src_mask'] is None:
+                self.unmasked.add(model_id)
+                return model.encode(src)
+
+            for j, b in enumerate(missing):
+                context = encoder_output['context'][:len(sentences[b]), j].clone()
+                contexts[keys[b]] = context
+                self.entries[keys[b]] = context
+
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+        # padded positions are masked in the attention, they are left at zero
+        context = pad_sequence([contexts[key] for key in keys])
+        src_mask = src.eq(onmt.Constants.PAD).t().unsqueeze(1)
+
+        return {'context': context, 'src_mask': src_mask}
@@ -0,0 +1,87 @@
+import torch
+import torch.nn.functional as F
+
+
+class EnsembleCombiner(object):
+    """
+    Combine the log-probabilities of the members of an ensemble, with optional weights.
+    Everything is computed in log space (in float, even if the models run in fp16),
+    so that no probability underflows:
+
+        mean:          log sum_i w_i p_i = m + log sum_i w_i exp(log p_i - m), m = max_i log p_i
+        logSum, gmean: log_softmax(sum_i w_i log p_i)   (normalized weighted geometric mean)
+        max, min:      max / min_i log p_i      (unweighted)
+
+    The models are accumulated one by one into preallocated buffers, which are reused
+    for the next steps (they only grow), and the outputs of the models are not modified.
+    """
+
+    ops = ['mean', 'logSum', 'gmean', 'max', 'min']
+
+    def __init__(self, op='mean', weights=None):
+        """
+        :param op: ensemble operator
+        :param weights: list of the weights of the models (normalized to sum to 1), None for uniform weights
+        """
+        if op not in self.ops:
+            raise ValueError('Ensemble operator needs to be one of %s, the current value is %s'
+                             % ("|".join(self.ops), op))
+
+        if weights is not None:
+            if min(weights) < 0 or sum(weights) <= 0:
+                raise ValueError('Ensemble weights need to be positive: %s' % str(weights))
+            weights = [w / sum(weights) for w in weights]
+
+        self.op = op
+        self.weights = weights
+        self.buffers = dict()
+
+    def _buffer(self, name, like):
+        buffer = self.buffers.get(name)
+
+        if buffer is None or buffer.device != like.device or buffer.numel() < like.numel():
+            buffer = torch.empty(like.numel(), dtype=torch.float, device=like.device)
+            self.buffers[name] = buffer
+
+        return buffer[:like.numel()].view(like.size())
+
+    def __call__(self, outputs):
+        """
+        :param outputs: list or dictionary (indexed from 0) of the log-probabilities of the models, ... x vocab_size
+        :return: the combined log-probabilities, ... x vocab_size
+        """
+        n_models = len(outputs)
+
+        if n_models == 1:
+            return outputs[0]
+
+        weights = self.weights if self.weights is not None else [1.0 / n_models] * n_models
+        if len(weights) != n_models:
+            raise ValueError('%d ensemble weights given for %d models' % (len(weights), n_models))
+
+        if self.op in ['max', 'min', 'mean']:
+            reduce = torch.min if self.op == 'min' else torch.max
+            extremum = self._buffer('extremum', outputs[0]).copy_(outputs[0])
+            for i in range(1, n_models):
+                reduce(extremum, outputs[i].float(), out=extremum)
+
+            if self.op != 'mean':
+                return extremum.clone()
+
+            # shift by the maximum before going to the probabilities, except where every model gives -inf
+            # (-inf - -inf is NaN, while without the shift the result is log(0) = -inf)
+            shift = extremum.masked_fill_(extremum.eq(float('-inf')), 0)
+            total = self._buffer('total', outputs[0]).zero_()
+            shifted = self._buffer('shifted', outputs[0])
+            for i in range(n_models):
+                torch.sub(outputs[i].float(), shift, out=shifted)
+                total.add_(shifted.exp_(), alpha=weights[i])
+
+            return torch.log(total).add_(shift)
+        else:
+            total = self._buffer('total', outputs[0])
+            torch.mul(outputs[0].float(), weights[0], out=total)
+            for i in range(1, n_models):
+                total.add_(outputs[i].float(), alpha=weights[i])
+
+            return F.log_softmax(total, dim=-1)
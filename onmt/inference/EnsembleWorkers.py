@@ -0,0 +1,48 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+
+class EnsembleWorkers(object):
+    """
+    Run the members of an ensemble concurrently, one worker thread per model.
+    The forward passes release the GIL, so the models of the ensemble decode their step
+    at the same time instead of one after the other. The worker threads share the memory
+    of the main thread: the decoder states stay in place and the log-probs are returned
+    as they are, to be combined with the usual ensemble_op.
+
+    Each worker uses its own share of the intra-op threads (the number of threads is a
+    per-thread setting), so that the members do not compete for the same cores.
+    """
+
+    def __init__(self, n_models, threads_per_model=0):
+        """
+        :param n_models: number of models in the ensemble
+        :param threads_per_model: intra-op threads of each worker (0: split the threads of the process evenly)
+        """
+        self.n_models = n_models
+
+        if threads_per_model <= 0:
+            threads_per_model = max(torch.get_num_threads() // n_models, 1)
+        self.threads_per_model = threads_per_model
+
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=n_models)
+
+    def _run(self, fn, i):
+        if not hasattr(self.local, 'initialized'):
+            torch.set_num_threads(self.threads_per_model)
+            self.local.initialized = True
+
+        # the autograd mode is thread local as well
+        with torch.no_grad():
+            return fn(i)
+
+    def map(self, fn):
+        """
+        :param fn: function of the model index
+        :return: the list of fn(i) for all models of the ensemble
+        """
+        futures = [self.executor.submit(self._run, fn, i) for i in range(self.n_models)]
+
+        return [future.result() for future in futures]
@@ -6,7 +6,8 @@ import math
 from torch.autograd import Variable
 from onmt.ModelConstructor import build_model
 import torch.nn.functional as F
-from onmt.inference.Search import BeamSearch, DiverseBeamSearch
+from onmt.inference.Search import BeamSearch, DiverseBeamSearch, GreedySearch, Sampling
+from onmt.inference.Shortlist import Shortlist
 import onmt.Translator as Translator
 
 model_list = ['transformer', 'stochastic_transformer']
@@ -19,7 +20,12 @@ class FastTranslator(Translator):
     def __init__(self, opt):
 
         super().__init__(opt)
-        self.search = BeamSearch(self.tgt_dict)
+        if opt.sampling:
+            self.search = Sampling(self.tgt_dict, opt.sampling_topk, opt.sampling_topp)
+        elif opt.beam_size == 1:
+            self.search = GreedySearch(self.tgt_dict)
+        else:
+            self.search = BeamSearch(self.tgt_dict)
         self.eos = onmt.Constants.EOS
         self.pad = onmt.Constants.PAD
         self.bos = self.bos_id
@@ -27,18 +33,36 @@ class FastTranslator(Translator):
         self.min_len = 1
         self.normalize_scores = opt.normalize
         self.len_penalty = opt.alpha
-        self.no_repeat_ngram_size = 0
+        self.no_repeat_ngram_size = opt.no_repeat_ngram_size
+        self.early_stop = opt.early_stop
+
+        # restrict the output layer to a lexical shortlist of the vocabulary
+        if opt.shortlist:
+            self.shortlist = Shortlist(opt.shortlist, topk=opt.shortlist_topk, frequent=opt.shortlist_frequent)
+            if opt.cuda:
+                self.shortlist.cuda()
+        else:
+            self.shortlist = None
+
+        # the search takes one extra step for the EOS marker
+        for model in self.models:
+            model.renew_buffer(self.opt.max_sent_length + 1)
 
         if opt.verbose:
             print('* Current bos id: %d' % self.bos_id, onmt.Constants.BOS )
             print('* Using fast beam search implementation')
 
-    def translateBatch(self, batch):
+    def translateBatch(self, batch, prefix_tokens=None):
 
         with torch.no_grad():
-            return self._translateBatch(batch)
+            return self._translateBatch(batch, prefix_tokens=prefix_tokens)
 
-    def _translateBatch(self, batch):
+    def _translateBatch(self, batch, prefix_tokens=None):
+        """
+        :param batch: Batch object
+        :param prefix_tokens: batch_size x len_prefix LongTensor (padded with PAD) of target tokens
+        every hypothesis of a sentence has to start with (the prefix is part of the output)
+        """
 
         # Batch size is in different location depending on data.
 
@@ -51,11 +75,14 @@ class FastTranslator(Translator):
         gold_words = 0
         allgold_scores = []
 
+        # run the encoders once, the outputs are shared by the gold scoring and the search
+        encoder_outputs = [self.encoder_cache.encode(model, batch, model_id=i) for i, model in enumerate(self.models)]
+
         if batch.has_target:
             # Use the first model to decode
             model_ = self.models[0]
 
-            gold_words, gold_scores, allgold_scores = model_.decode(batch)
+            gold_words, gold_scores, allgold_scores = model_.decode(batch, encoder_output=encoder_outputs[0])
 
         #  (3) Start decoding
 
@@ -71,12 +98,14 @@ class FastTranslator(Translator):
         src_tokens = src.transpose(0, 1)  # batch x time
         src_lengths = (src_tokens.ne(self.eos) & src_tokens.ne(self.pad)).long().sum(dim=1)
         blacklist = src_tokens.new_zeros(bsz, beam_size).eq(-1)  # forward and backward-compatible False mask
-        prefix_tokens = None
+        if prefix_tokens is not None:
+            prefix_tokens = prefix_tokens.to(src.device)
 
         # list of completed sentences
         finalized = [[] for i in range(bsz)]
         finished = [False for i in range(bsz)]
         num_remaining_sent = bsz
+        remaining_sents = list(range(bsz))  # the sentence of each row of the (compacted) batch
 
         # number of candidate hypos per step
         cand_size = 2 * beam_size  # 2 x beam size in case half are EOS
@@ -104,6 +133,32 @@ class FastTranslator(Translator):
                 return True
             return False
 
+        def stop_early(step, unfinalized_scores):
+            """
+            Finish the sentences whose finalized hypotheses can not be beaten by the active ones anymore.
+            The log-probabilities are never positive, so the score of a hypothesis can only decrease
+            (the length normalization can only raise it up to the maximum length). The finalized
+            hypotheses are then exactly the best ones the full search would have returned.
+            Args:
+                step: current time step
+                unfinalized_scores: A vector of size bsz with the best score of an active
+                    hypothesis of each remaining sentence
+            Return: the indices (in the current batch) of the finished sentences
+            """
+            if self.normalize_scores:
+                length = max_len + 1 if self.len_penalty >= 0 else step + 2
+                unfinalized_scores = unfinalized_scores / length ** self.len_penalty
+
+            newly_finished = []
+            for unfin_idx, best_unfinalized_score in enumerate(unfinalized_scores.tolist()):
+                sent = remaining_sents[unfin_idx]
+                if finished[sent] or len(finalized[sent]) == 0:
+                    continue
+                if min(hypo['score'] for hypo in finalized[sent]) >= best_unfinalized_score:
+                    finished[sent] = True
+                    newly_finished.append(unfin_idx)
+            return newly_finished
+
         def finalize_hypos(step, bbsz_idx, eos_scores):
             """
             Finalize the given hypotheses at this step, while keeping the total
@@ -186,11 +241,20 @@ class FastTranslator(Translator):
         batch_idxs = None
 
         # initialize the decoder state, including:
-        # - expanding the context over the batch dimension len_src x (B*beam) x H
-        # - expanding the mask over the batch dimension    (B*beam) x len_src
+        # - keeping the context once per sentence (shared by its beams)  len_src x B x H
+        # - keeping the mask once per sentence                           B x len_src
+        # - preallocating the self-attention buffers                     (max_len + 1) x (B*beam) x H
         decoder_states = dict()
         for i in range(self.n_models):
-            decoder_states[i] = self.models[i].create_decoder_state(batch, beam_size, type=2)
+            decoder_states[i] = self.models[i].create_decoder_state(batch, beam_size, type=2, max_len=max_len + 1,
+                                                                    encoder_output=encoder_outputs[i])
+
+        # project the decoder output onto the shortlist of the batch only
+        shortlist_ids = None
+        if self.shortlist is not None and src.dim() == 2 and all(hasattr(model, 'generator') for model in self.models):
+            shortlist_ids = self.shortlist.candidates(src, extra=prefix_tokens)
+            for i, model in enumerate(self.models):
+                decoder_states[i].shortlist = model.generator[0].select_shortlist(shortlist_ids)
 
         # Start decoding
         for step in range(max_len + 1):  # one extra step for EOS marker
@@ -205,6 +269,11 @@ class FastTranslator(Translator):
 
             decode_input = tokens[:, :step + 1]
             lprobs, avg_attn_scores = self._decode(decode_input, decoder_states)
+
+            if shortlist_ids is not None:
+                # map the shortlist back to the vocabulary, the other words are never selected
+                lprobs = lprobs.new_full((lprobs.size(0), self.vocab_size), -math.inf).scatter_(
+                    1, shortlist_ids.unsqueeze(0).expand(lprobs.size(0), -1), lprobs)
             avg_attn_scores = None
 
             lprobs[:, self.pad] = -math.inf  # never select pad
@@ -216,43 +285,14 @@ class FastTranslator(Translator):
             elif step < self.min_len:
                 lprobs[:, self.eos] = -math.inf
 
-            # handle prefix tokens (possibly with different lengths)
-            # if prefix_tokens is not None and step < prefix_tokens.size(1):
-            #     prefix_toks = prefix_tokens[:, step].unsqueeze(-1).repeat(1, beam_size).view(-1)
-            #     prefix_lprobs = lprobs.gather(-1, prefix_toks.unsqueeze(-1))
-            #     prefix_mask = prefix_toks.ne(self.pad)
-            #     lprobs[prefix_mask] = -math.inf
-            #     lprobs[prefix_mask] = lprobs[prefix_mask].scatter_(
-            #         -1, prefix_toks[prefix_mask].unsqueeze(-1), prefix_lprobs
-            #     )
-            #     # if prefix includes eos, then we should make sure tokens and
-            #     # scores are the same across all beams
-            #     eos_mask = prefix_toks.eq(self.eos)
-            #     if eos_mask.any():
-            #         # validate that the first beam matches the prefix
-            #         first_beam = tokens[eos_mask].view(-1, beam_size, tokens.size(-1))[:, 0, 1:step + 1]
-            #         eos_mask_batch_dim = eos_mask.view(-1, beam_size)[:, 0]
-            #         target_prefix = prefix_tokens[eos_mask_batch_dim][:, :step]
-            #         assert (first_beam == target_prefix).all()
-            #
-            #         def replicate_first_beam(tensor, mask):
-            #             tensor = tensor.view(-1, beam_size, tensor.size(-1))
-            #             tensor[mask] = tensor[mask][:, :1, :]
-            #             return tensor.view(-1, tensor.size(-1))
-            #
-            #         # copy tokens, scores and lprobs from the first beam to all beams
-            #         tokens = replicate_first_beam(tokens, eos_mask_batch_dim)
-            #         scores = replicate_first_beam(scores, eos_mask_batch_dim)
-            #         lprobs = replicate_first_beam(lprobs, eos_mask_batch_dim)
-
-            if self.no_repeat_ngram_size > 0:
-                # for each beam and batch sentence, generate a list of previous ngrams
-                gen_ngrams = [{} for bbsz_idx in range(bsz * beam_size)]
-                for bbsz_idx in range(bsz * beam_size):
-                    gen_tokens = tokens[bbsz_idx].tolist()
-                    for ngram in zip(*[gen_tokens[i:] for i in range(self.no_repeat_ngram_size)]):
-                        gen_ngrams[bbsz_idx][tuple(ngram[:-1])] = \
-                            gen_ngrams[bbsz_idx].get(tuple(ngram[:-1]), []) + [ngram[-1]]
+            # handle prefix tokens (possibly with different lengths): while a sentence has prefix tokens left,
+            # its hypotheses can only be extended with the next one (sentences with shorter prefixes are padded)
+            if prefix_tokens is not None and step < prefix_tokens.size(1) and step < max_len:
+                prefix_toks = prefix_tokens[:, step].unsqueeze(-1).repeat(1, beam_size).view(-1)
+                prefix_lprobs = lprobs.gather(-1, prefix_toks.unsqueeze(-1))
+                prefix_mask = prefix_toks.ne(self.pad)
+            else:
+                prefix_mask = None
 
             # Record attention scores
             if avg_attn_scores is not None:
@@ -266,20 +306,17 @@ class FastTranslator(Translator):
             eos_bbsz_idx = buffer('eos_bbsz_idx')
             eos_scores = buffer('eos_scores', type_of=scores)
 
-            if self.no_repeat_ngram_size > 0:
-                def calculate_banned_tokens(bbsz_idx):
-                    # before decoding the next token, prevent decoding of ngrams that have already appeared
-                    ngram_index = tuple(tokens[bbsz_idx, step + 2 - self.no_repeat_ngram_size:step + 1].tolist())
-                    return gen_ngrams[bbsz_idx].get(ngram_index, [])
-
-                if step + 2 - self.no_repeat_ngram_size >= 0:
-                    # no banned tokens if we haven't generated no_repeat_ngram_size tokens yet
-                    banned_tokens = [calculate_banned_tokens(bbsz_idx) for bbsz_idx in range(bsz * beam_size)]
-                else:
-                    banned_tokens = [[] for bbsz_idx in range(bsz * beam_size)]
+            # before decoding the next token, prevent decoding of ngrams that have already appeared
+            # (no banned tokens if we haven't generated no_repeat_ngram_size tokens yet)
+            if self.no_repeat_ngram_size > 0 and step + 2 - self.no_repeat_ngram_size > 0:
+                lprobs = self._block_repeated_ngrams(tokens[:, :step + 1], lprobs)
 
-                for bbsz_idx in range(bsz * beam_size):
-                    lprobs[bbsz_idx, banned_tokens[bbsz_idx]] = -math.inf
+            # the prefix is forced after the ngram blocking, so that it is kept even if it repeats an ngram
+            if prefix_mask is not None and prefix_mask.any():
+                lprobs[prefix_mask] = -math.inf
+                lprobs[prefix_mask] = lprobs[prefix_mask].scatter_(
+                    -1, prefix_toks[prefix_mask].unsqueeze(-1), prefix_lprobs[prefix_mask]
+                )
 
             cand_scores, cand_indices, cand_beams = self.search.step(
                 step,
@@ -294,6 +331,9 @@ class FastTranslator(Translator):
 
             # finalize hypotheses that end in eos (except for blacklisted ones)
             eos_mask = cand_indices.eq(self.eos)
+            if prefix_tokens is not None and step < max_len:
+                # the hypotheses cut off by the prefix (-inf) can not end
+                eos_mask &= cand_scores.ne(-math.inf)
             eos_mask[:, :beam_size][blacklist] = 0
 
             # only consider eos when it's among the top beam_size indices
@@ -313,6 +353,12 @@ class FastTranslator(Translator):
                 finalized_sents = finalize_hypos(step, eos_bbsz_idx, eos_scores)
                 num_remaining_sent -= len(finalized_sents)
 
+            if self.early_stop and step < max_len:
+                unfinalized_scores = cand_scores.masked_fill(cand_indices.eq(self.eos), -math.inf).max(dim=1)[0]
+                stopped_sents = stop_early(step, unfinalized_scores)
+                finalized_sents = list(finalized_sents) + stopped_sents
+                num_remaining_sent -= len(stopped_sents)
+
             assert num_remaining_sent >= 0
             if num_remaining_sent == 0:
                 break
@@ -325,6 +371,7 @@ class FastTranslator(Translator):
                 batch_mask = cand_indices.new_ones(bsz)
                 batch_mask[cand_indices.new(finalized_sents)] = 0
                 batch_idxs = batch_mask.nonzero().squeeze(-1)
+                remaining_sents = [remaining_sents[i] for i in batch_idxs.tolist()]
 
                 eos_mask = eos_mask[batch_idxs]
                 cand_beams = cand_beams[batch_idxs]
@@ -332,8 +379,8 @@ class FastTranslator(Translator):
                 cand_bbsz_idx = cand_beams.add(bbsz_offsets)
                 cand_scores = cand_scores[batch_idxs]
                 cand_indices = cand_indices[batch_idxs]
-                # if prefix_tokens is not None:
-                #     prefix_tokens = prefix_tokens[batch_idxs]
+                if prefix_tokens is not None:
+                    prefix_tokens = prefix_tokens[batch_idxs]
                 src_lengths = src_lengths[batch_idxs]
                 blacklist = blacklist[batch_idxs]
 
@@ -426,14 +473,37 @@ class FastTranslator(Translator):
 
         return finalized, gold_scores, gold_words, allgold_scores
 
+    def _block_repeated_ngrams(self, tokens, lprobs):
+        """
+        Ban the tokens that would repeat an ngram of the hypothesis
+        :param tokens: (B*beam) x len_tgt, the tokens generated so far
+        :param lprobs: (B*beam) x vocab_size, log-probabilities of the next token
+        :return: lprobs with -inf for the banned tokens
+        """
+        n = self.no_repeat_ngram_size
+
+        # all ngrams of the hypotheses: (B*beam) x n_ngrams x n
+        ngrams = tokens.unfold(1, n, 1)
+
+        # an ngram is repeated if its first n-1 tokens are the last n-1 tokens of the hypothesis
+        last_tokens = tokens[:, tokens.size(1) - n + 1:].unsqueeze(1)
+        match = ngrams[:, :, :-1].eq(last_tokens).all(dim=2)
+
+        # pad is never selected anyway, so it takes the place of the unmatched ngrams
+        banned_tokens = ngrams[:, :, -1].masked_fill(~match, self.pad)
+
+        return lprobs.scatter_(1, banned_tokens, -math.inf)
+
     def _decode(self, tokens, decoder_states):
 
         # require batch first for everything
         outs = dict()
         attns = dict()
 
+        decoder_outputs = self._run_models(lambda i: self.models[i].step(tokens, decoder_states[i]))
+
         for i in range(self.n_models):
-            decoder_output = self.models[i].step(tokens, decoder_states[i])
+            decoder_output = decoder_outputs[i]
 
             # take the last decoder state
             # decoder_hidden = decoder_hidden.squeeze(1)
@@ -451,31 +521,59 @@ class FastTranslator(Translator):
 
         return out, attn
 
-    def translate(self, src_data, tgt_data, type='mt'):
+    def build_prefix(self, prefix_sents):
+        """
+        :param prefix_sents: list of target token lists (may be empty)
+        :return: batch_size x len_prefix LongTensor padded with PAD, or None if all prefixes are empty
+        """
+        prefix_data = [self.tgt_dict.convertToIdx(p, onmt.Constants.UNK_WORD) for p in prefix_sents]
+        max_len = max(p.size(0) for p in prefix_data)
+
+        if max_len == 0:
+            return None
+
+        prefix_tokens = torch.LongTensor(len(prefix_data), max_len).fill_(self.pad)
+        for i, p in enumerate(prefix_data):
+            prefix_tokens[i, :p.size(0)].copy_(p)
+
+        return prefix_tokens
+
+    def translate(self, src_data, tgt_data, type='mt', prefix_data=None):
+        """
+        :param src_data: list of source token lists
+        :param tgt_data: list of target token lists (for gold scores, may be empty)
+        :param prefix_data: optional list of target token lists the translations have to start with,
+        e.g. the part of the output already committed in interactive or streaming decoding
+        """
         #  (1) convert words to indexes
         dataset = self.build_data(src_data, tgt_data, type=type)
-        batch = dataset.next()[0]
-        if self.cuda:
-            batch.cuda(fp16=self.fp16)
-        # ~ batch = self.to_variable(dataset.next()[0])
-        batch_size = batch.size
-
-        #  (2) translate
-        finalized, gold_score, gold_words, allgold_words = self.translateBatch(batch)
+        batch_size = len(src_data)
+
+        translate_fn = self.translateBatch
+        if prefix_data is not None:
+            # the mini-batches follow the input order
+            prefixes = iter([self.build_prefix([prefix_data[i] for i in ids]) for ids in dataset.batches])
+
+            def translate_fn(batch):
+                return self.translateBatch(batch, prefix_tokens=next(prefixes))
+
+        #  (2) translate (the batch is split further if it exceeds batch_size_words)
+        finalized, gold_score, gold_words, allgold_words = self.translate_dataset(dataset, translate_fn)
         pred_length = []
 
         #  (3) convert indexes to words
+        # with early stopping a sentence can have less than n_best hypotheses
         pred_batch = []
         for b in range(batch_size):
             pred_batch.append(
                 [self.build_target_tokens(finalized[b][n]['tokens'], src_data[b], None)
-                 for n in range(self.opt.n_best)]
+                 for n in range(min(self.opt.n_best, len(finalized[b])))]
             )
         pred_score = []
         for b in range(batch_size):
             pred_score.append(
                 [torch.FloatTensor([finalized[b][n]['score']])
-                 for n in range(self.opt.n_best)]
+                 for n in range(min(self.opt.n_best, len(finalized[b])))]
             )
 
         return pred_batch, pred_score, pred_length, gold_score, gold_words, allgold_words
@@ -0,0 +1,98 @@
+import sys
+import argparse
+
+
+def add_decoding_options(parser):
+    """
+    Add the options of the translators (onmt.Translator and FastTranslator) to the parser.
+    They are shared by translate.py and server.py, and are the defaults of the config file of OnlineTranslator
+    """
+    parser.add_argument('-lm', required=False,
+                        help='Path to language model .pt file. Used for cold fusion')
+    parser.add_argument('-autoencoder', required=False,
+                        help='Path to autoencoder .pt file')
+    parser.add_argument('-input_type', default="word",
+                        help="Input type: word/char")
+    parser.add_argument('-attributes', default="",
+                        help='Attributes for the decoder. Split them by |   ')
+    parser.add_argument('-encoder_type', default='text',
+                        help="Type of encoder to use. Options are [text|img|audio].")
+    parser.add_argument('-beam_size', type=int, default=5,
+                        help='Beam size')
+    parser.add_argument('-batch_size_words', type=int, default=sys.maxsize,
+                        help='Maximum number of source tokens (padding included) times beam size in a batch')
+    parser.add_argument('-encoder_cache_size', type=int, default=0,
+                        help="""Number of distinct source sentences whose encoder outputs are kept
+                        and reused for repeated inputs (0 to disable)""")
+    parser.add_argument('-max_sent_length', type=int, default=256,
+                        help='Maximum sentence length.')
+    parser.add_argument('-replace_unk', action="store_true",
+                        help="""Replace the generated UNK tokens with the source
+                        token that had highest attention weight. If phrase_table
+                        is provided, it will lookup the identified source token and
+                        give the corresponding target token. If it is not provided
+                        (or the identified source token does not exist in the
+                        table) then it will copy the source token""")
+    parser.add_argument('-start_with_bos', action="store_true",
+                        help="""Add BOS token to the top of the source sentence""")
+    parser.add_argument('-verbose', action="store_true",
+                        help='Print scores and predictions for each sentence')
+    parser.add_argument('-sampling', action="store_true",
+                        help='Using multinomial sampling instead of beam search')
+    parser.add_argument('-shortlist', default='',
+                        help="""Vocabulary shortlist built with build_shortlist.py: the output layer only
+                        projects onto the frequent words and the translations of the source words (fast_translate)""")
+    parser.add_argument('-shortlist_topk', type=int, default=-1,
+                        help='Number of shortlist words kept for each source word (-1 for all in the table)')
+    parser.add_argument('-shortlist_frequent', type=int, default=-1,
+                        help='Number of most frequent target words always in the shortlist (-1 for all in the table)')
+    parser.add_argument('-early_stop', action='store_true',
+                        help="""Finish a sentence as soon as no active hypothesis can beat the finalized ones
+                        (fast_translate). The best hypothesis is unchanged, but less than n_best may be returned""")
+    parser.add_argument('-no_repeat_ngram_size', type=int, default=0,
+                        help='Never generate the same ngram of this size twice (fast_translate, 0 to disable)')
+    parser.add_argument('-sampling_topk', type=int, default=-1,
+                        help='Sample from the k most likely tokens only (fast_translate, -1 to disable)')
+    parser.add_argument('-sampling_topp', type=float, default=-1.0,
+                        help="""Sample from the smallest set of tokens whose cumulative probability
+                        exceeds p (nucleus sampling, fast_translate, -1 to disable)""")
+    parser.add_argument('-dump_beam', type=str, default="",
+                        help='File to dump beam information to.')
+    parser.add_argument('-bos_token', type=str, default="<s>",
+                        help='BOS Token (used in multilingual model). Default is <s>.')
+    parser.add_argument('-no_bos_gold', action="store_true",
+                        help='BOS Token (used in multilingual model). Default is <s>.')
+    parser.add_argument('-n_best', type=int, default=1,
+                        help="""If verbose is set, will output the n_best
+                        decoded sentences""")
+    parser.add_argument('-alpha', type=float, default=0.6,
+                        help="""Length Penalty coefficient""")
+    parser.add_argument('-beta', type=float, default=0.0,
+                        help="""Coverage penalty coefficient""")
+    parser.add_argument('-ensemble_op', default='mean', help="""Ensembling operator: mean|logSum|gmean|max|min""")
+    parser.add_argument('-ensemble_weights', default='',
+                        help='Weights of the models of the ensemble separated by | (uniform by default)')
+    parser.add_argument('-ensemble_workers', action='store_true',
+                        help='Run the models of an ensemble in parallel, each in its own worker thread')
+    parser.add_argument('-ensemble_threads', type=int, default=0,
+                        help='Number of intra-op threads of each ensemble worker (0 to share the cores evenly)')
+    parser.add_argument('-normalize', action='store_true',
+                        help='To normalize the scores based on output length')
+    parser.add_argument('-fp16', action='store_true',
+                        help='To use floating point 16 in decoding')
+    parser.add_argument('-quantize', default='',
+                        help="""Quantize the linear layers of the models for decoding on CPU: int8.
+                        Not needed for the checkpoints saved by quantize.py""")
+    parser.add_argument('-gpu', type=int, default=-1,
+                        help="Device to run on")
+    parser.add_argument('-fast_translate', action='store_true',
+                        help='Using the fast decoder')
+
+    return parser
+
+
+def decoding_defaults():
+    """
+    :return: the default values of the decoding options (argparse.Namespace)
+    """
+    return add_decoding_options(argparse.ArgumentParser()).parse_args([])
@@ -0,0 +1,38 @@
+import torch
+import torch.nn as nn
+from onmt.modules.GlobalAttention import MultiHeadAttention
+from onmt.modules.Linear import XavierLinear
+
+quantize_types = {'int8': torch.qint8}
+
+
+def quantize_model(model, quantize='int8'):
+    """
+    Dynamic quantization of the model for decoding on CPU: the weights of the linear layers
+    (the projections of the encoder and decoder layers and the output layer of the generator)
+    are stored in int8, and the activations are quantized on the fly at each call,
+    so that no calibration data is needed.
+
+    The projections computed with group_linear are merged into one layer beforehand,
+    since the weights of the quantized layers can not be concatenated on the fly,
+    and the merged projections are removed so that they are not quantized and saved twice.
+    This is also done before loading a quantized checkpoint, so that the model has the same layers.
+
+    :param model: float model on CPU
+    :param quantize: type of the quantized weights (int8)
+    :return: the quantized model (a copy)
+    """
+    if quantize not in quantize_types:
+        raise ValueError('Quantization type needs to be one of %s, the current value is %s'
+                         % ("|".join(quantize_types), quantize))
+
+    # list first, since the attention modules get a new submodule
+    for module in list(model.modules()):
+        if isinstance(module, XavierLinear) and module.weight_norm:
+            nn.utils.remove_weight_norm(module.linear)
+            module.weight_norm = False
+
+        if isinstance(module, MultiHeadAttention):
+            module.fuse_projections()
+
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=quantize_types[quantize])
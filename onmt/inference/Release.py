@@ -0,0 +1,155 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def data_file_path(path):
+    return path + '.bin'
+
+
+def _align(offset, alignment=64):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def save_release(model, model_opt, dicts, path, fp16=False):
+    """
+    Save a model for inference only: the weights are written one after the other in a flat binary file
+    (path.bin), and path is a small checkpoint with the options, the dictionaries and the index of the
+    weights (name, type, shape and offset in the binary file), without the optimizer state.
+    The binary file is mapped in memory when the checkpoint is loaded (load_checkpoint),
+    so that the processes decoding with the same model on a host share its pages.
+
+    :param model: model in float, on CPU (the tied weights are written once, and the buffers
+    that the model computes again are not written)
+    :param fp16: write the floating point weights in half precision
+    """
+    index = list()
+    written = dict()
+    offset = 0
+
+    with open(data_file_path(path), 'wb') as data_file:
+        for name, tensor in model.state_dict().items():
+            if hasattr(model, 'restores_state') and not model.restores_state(name):
+                continue
+
+            # the tied weights are found on the tensors of the model: the address of a
+            # temporary copy (the half precision cast) can be reused by the next one
+            key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.size()), tensor.stride())
+            if tensor.numel() > 0 and key in written:
+                index.append((name,) + written[key])
+                continue
+
+            if fp16 and tensor.is_floating_point():
+                tensor = tensor.half()
+
+            np_array = tensor.contiguous().numpy()
+
+            # aligned, so that every tensor can be viewed in place
+            padding = _align(offset) - offset
+            data_file.write(b'\x00' * padding)
+            offset += padding
+
+            written[key] = (np_array.dtype.str, np_array.shape, offset)
+            index.append((name,) + written[key])
+
+            data_file.write(np_array.tobytes(order='C'))
+            offset += np_array.nbytes
+
+    checkpoint = {
+        'model': None,
+        'dicts': dicts,
+        'opt': model_opt,
+        'release': {'data': os.path.basename(data_file_path(path)), 'tensors': index},
+        'epoch': -1,
+        'iteration': -1,
+        'batchOrder': None,
+        'optim': None
+    }
+
+    torch.save(checkpoint, path)
+
+
+def map_release_weights(path, release):
+    """
+    :return: the state dict of the model, as tensors viewing the binary file mapped in memory
+    (copy on write: the pages are shared as long as the weights are not modified)
+    """
+    data_path = os.path.join(os.path.dirname(path), release['data'])
+    buffer = np.memmap(data_path, mode='c', order='C')
+
+    state_dict = OrderedDict()
+    for name, dtype, shape, offset in release['tensors']:
+        dtype = np.dtype(dtype)
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        np_array = buffer[offset:offset + n_bytes].view(dtype).reshape(shape)
+        state_dict[name] = torch.from_numpy(np_array)
+
+    return state_dict
+
+
+def load_checkpoint(path):
+    """
+    torch.load of a training checkpoint, or of a release checkpoint (save_release)
+    whose weights are then mapped in memory
+    """
+    checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+
+    if 'release' in checkpoint:
+        checkpoint['model'] = map_release_weights(path, checkpoint['release'])
+
+    return checkpoint
+
+
+def check_release(state_dict, path, fp16=False):
+    """
+    Compare the weights mapped from a release checkpoint with the state dict it was written from
+
+    :return: the names of the tensors that differ (or are missing)
+    """
+    release = torch.load(path, map_location=lambda storage, loc: storage)['release']
+    weights = map_release_weights(path, release)
+
+    mismatches = list()
+    for name, dtype, shape, offset in release['tensors']:
+        tensor = state_dict[name]
+        if fp16 and tensor.is_floating_point():
+            tensor = tensor.half()
+
+        if name not in weights or not torch.equal(weights[name], tensor):
+            mismatches.append(name)
+
+    return mismatches
+
+
+def share_weights(model, state_dict):
+    """
+    Load the mapped weights of a release checkpoint without copying them:
+    the parameters and buffers of the model become views of the binary file.
+    The tensors of a different type (fp16 weights in a float model) are copied.
+    """
+    for module_name, module in model.named_modules():
+        prefix = module_name + '.' if module_name else ''
+        for tensors in [module._parameters, module._buffers]:
+            for name, tensor in tensors.items():
+                if tensor is None:
+                    continue
+
+                if prefix + name not in state_dict:
+                    if tensors is module._parameters:
+                        raise KeyError('Missing weight in the release checkpoint: %s' % (prefix + name))
+                    continue
+
+                weight = state_dict[prefix + name]
+                if weight.size() != tensor.size():
+                    # buffers renewed for the decoding length (positional encodings, masks)
+                    if tensors is module._buffers:
+                        continue
+                    raise ValueError('Size mismatch for %s: %s in the release checkpoint, %s in the model'
+                                     % (prefix + name, str(weight.size()), str(tensor.size())))
+
+                if weight.dtype == tensor.dtype:
+                    tensor.data = weight
+                else:
+                    tensor.data.copy_(weight)
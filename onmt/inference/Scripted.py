@@ -0,0 +1,480 @@
+import math
+import pickle
+import zipfile
+from collections import defaultdict
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+import onmt
+from onmt.modules.BaseModel import DecoderState
+from onmt.modules.GlobalAttention import IncrementalCache
+from onmt.modules.Linear import XavierLinear, FeedForwardSwish
+from onmt.inference.Quantization import quantize_types
+
+
+def _copy_linear(linears):
+    """nn.Linear holding the concatenated weights (and biases) of the given linear layers"""
+    weight = torch.cat([linear.weight.data for linear in linears], dim=0)
+    bias = all(linear.bias is not None for linear in linears)
+
+    copy = nn.Linear(weight.size(1), weight.size(0), bias=bias).to(weight)
+    copy.weight.data.copy_(weight)
+    if bias:
+        copy.bias.data.copy_(torch.cat([linear.bias.data for linear in linears]))
+
+    return copy
+
+
+def _attention(query: Tensor, key: Tensor, value: Tensor, mask: Optional[Tensor], n_heads: int) -> Tuple[Tensor, Tensor]:
+    """
+    Multi-head attention on projected inputs (time first).
+    The keys can have fewer rows than the queries: the row s of the keys is then shared by the
+    beam_size consecutive query rows of the sentence s (sentence major, as in MultiHeadAttention.step)
+
+    Inputs Shapes:
+        query: len_query x n_rows x d_model
+        key:   len_key x n_keys x d_model
+        value: len_key x n_keys x d_model
+        mask:  n_keys x 1 x len_key (True for the masked positions)
+    Outputs Shapes:
+        out:      len_query x n_rows x d_model
+        coverage: n_rows x len_query x len_key (mean attention of the heads)
+    """
+    len_query, n_rows, d_model = query.size(0), query.size(1), query.size(2)
+    len_key, n_keys = key.size(0), key.size(1)
+    beam_size = n_rows // n_keys
+    d_head = d_model // n_heads
+
+    q = query.contiguous().view(len_query, n_keys, beam_size, n_heads, d_head)
+    q = q.permute(1, 3, 2, 0, 4).contiguous().view(n_keys * n_heads, beam_size * len_query, d_head)
+    k = key.contiguous().view(len_key, n_keys * n_heads, d_head).transpose(0, 1)
+    v = value.contiguous().view(len_key, n_keys * n_heads, d_head).transpose(0, 1)
+
+    q = q * (d_head ** -0.5)
+
+    attns = torch.bmm(q, k.transpose(1, 2)).view(n_keys, n_heads, beam_size, len_query, len_key)
+    if mask is not None:
+        attns = attns.float().masked_fill(mask.unsqueeze(1).unsqueeze(1), float('-inf'))
+    attns = F.softmax(attns.float(), dim=-1).type_as(value)
+
+    coverage = torch.mean(attns, dim=1).view(n_rows, len_query, len_key)
+
+    out = torch.bmm(attns.view(n_keys * n_heads, beam_size * len_query, len_key), v)
+    out = out.view(n_keys, n_heads, beam_size, len_query, d_head)
+    out = out.permute(3, 0, 2, 1, 4).contiguous().view(len_query, n_rows, d_model)
+
+    return out, coverage
+
+
+class ScriptedFeedForward(nn.Module):
+
+    def __init__(self, feedforward):
+        super(ScriptedFeedForward, self).__init__()
+        self.fc_1 = _copy_linear([feedforward.fc_1.linear])
+        self.fc_2 = _copy_linear([feedforward.fc_2.linear])
+        self.swish = isinstance(feedforward, FeedForwardSwish)
+
+    def forward(self, input: Tensor) -> Tensor:
+        out = self.fc_1(input)
+        if self.swish:
+            out = out * torch.sigmoid(out)
+        else:
+            out = F.relu(out)
+
+        return self.fc_2(out)
+
+
+class ScriptedEncoderLayer(nn.Module):
+
+    def __init__(self, layer):
+        super(ScriptedEncoderLayer, self).__init__()
+        attention = layer.multihead
+        self.n_heads = attention.h
+
+        self.attn_norm = layer.preprocess_attn.layer_norm.function
+        self.fc_query = _copy_linear([attention.fc_query.function.linear])
+        self.fc_kv = _copy_linear([attention.fc_key.function.linear, attention.fc_value.function.linear])
+        self.fc_concat = _copy_linear([attention.fc_concat.function.linear])
+
+        self.ffn_norm = layer.preprocess_ffn.layer_norm.function
+        self.feedforward = ScriptedFeedForward(layer.feedforward.function)
+
+    def forward(self, input: Tensor, mask: Tensor) -> Tensor:
+        query = self.attn_norm(input)
+        key, value = self.fc_kv(query).chunk(2, dim=-1)
+        out, _ = _attention(self.fc_query(query), key, value, mask, self.n_heads)
+        input = input + self.fc_concat(out)
+
+        return input + self.feedforward(self.ffn_norm(input))
+
+
+class ScriptedDecoderLayer(nn.Module):
+
+    def __init__(self, layer):
+        super(ScriptedDecoderLayer, self).__init__()
+        attention, src_attention = layer.multihead_tgt, layer.multihead_src
+        self.n_heads = attention.h
+
+        self.attn_norm = layer.preprocess_attn.layer_norm.function
+        self.fc_qkv = _copy_linear([attention.fc_query.function.linear, attention.fc_key.function.linear,
+                                    attention.fc_value.function.linear])
+        self.fc_concat = _copy_linear([attention.fc_concat.function.linear])
+
+        self.src_attn_norm = layer.preprocess_src_attn.layer_norm.function
+        self.src_fc_query = _copy_linear([src_attention.fc_query.function.linear])
+        self.src_fc_kv = _copy_linear([src_attention.fc_key.function.linear, src_attention.fc_value.function.linear])
+        self.src_fc_concat = _copy_linear([src_attention.fc_concat.function.linear])
+
+        self.ffn_norm = layer.preprocess_ffn.layer_norm.function
+        self.feedforward = ScriptedFeedForward(layer.feedforward.function)
+
+    @torch.jit.export
+    def source_keys(self, context: Tensor) -> Tuple[Tensor, Tensor]:
+        key, value = self.src_fc_kv(context).chunk(2, dim=-1)
+
+        return key.contiguous(), value.contiguous()
+
+    def forward(self, input: Tensor, keys: Tensor, values: Tensor, tgt_mask: Optional[Tensor],
+                src_keys: Tensor, src_values: Tensor, src_mask: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        :param input: 1 x n_rows x d_model
+        :param keys: len_tgt x n_rows x d_model, the key of the current step is written in the last row
+        :param values: len_tgt x n_rows x d_model, same as the keys
+        :param tgt_mask: n_rows x 1 x len_tgt, the padded target positions (None if there is none)
+        """
+        query, key, value = self.fc_qkv(self.attn_norm(input)).chunk(3, dim=-1)
+        keys[-1].copy_(key[0])
+        values[-1].copy_(value[0])
+        out, _ = _attention(query, keys, values, tgt_mask, self.n_heads)
+        input = input + self.fc_concat(out)
+
+        out, coverage = _attention(self.src_fc_query(self.src_attn_norm(input)), src_keys, src_values,
+                                   src_mask, self.n_heads)
+        input = input + self.src_fc_concat(out)
+
+        return input + self.feedforward(self.ffn_norm(input)), coverage
+
+
+class ScriptedTransformerModule(nn.Module):
+    """
+    The inference graph of a Transformer (text encoder) in TorchScript:
+    forward runs the encoder, source_keys projects the context for the source attention of every layer
+    and step runs one incremental decoder step with the generator.
+    The weights are copied from the model, with the projections of group_linear merged into one layer.
+    """
+
+    def __init__(self, model):
+        super(ScriptedTransformerModule, self).__init__()
+        encoder, decoder = model.encoder, model.decoder
+
+        self.model_size = decoder.model_size
+        self.n_layers = len(decoder.layer_modules)
+        self.pad = onmt.Constants.PAD
+
+        self.src_embedding = encoder.word_lut
+        self.encoder_layers = nn.ModuleList([ScriptedEncoderLayer(layer) for layer in encoder.layer_modules])
+        self.encoder_norm = encoder.postprocess_layer.layer_norm.function
+
+        self.tgt_embedding = decoder.word_lut
+        self.decoder_layers = nn.ModuleList([ScriptedDecoderLayer(layer) for layer in decoder.layer_modules])
+        self.decoder_norm = decoder.postprocess_layer.layer_norm.function
+
+        self.generator = _copy_linear([model.generator[0].linear])
+
+        # the positional encodings are computed on the fly (same as PositionalEncoding.renew)
+        num_timescales = self.model_size // 2
+        log_timescale_increment = math.log(10000) / (num_timescales - 1)
+        inv_timescales = torch.exp(torch.arange(0, num_timescales).float() * -log_timescale_increment)
+        self.register_buffer('inv_timescales', inv_timescales)
+
+    def positional_encoding(self, start: int, length: int) -> Tensor:
+        position = torch.arange(start, start + length, device=self.inv_timescales.device).float()
+        scaled_time = position.unsqueeze(1) * self.inv_timescales.float().unsqueeze(0)
+
+        return torch.cat((torch.sin(scaled_time), torch.cos(scaled_time)), 1)
+
+    def forward(self, input: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        :param input: batch_size x len_src
+        :return: the context (len_src x batch_size x d_model) and the source mask (batch_size x 1 x len_src)
+        """
+        mask = input.eq(self.pad).unsqueeze(1)
+
+        emb = self.src_embedding(input) * math.sqrt(self.model_size)
+        emb = emb + self.positional_encoding(0, input.size(1)).type_as(emb)
+
+        context = emb.transpose(0, 1)
+        for layer in self.encoder_layers:
+            context = layer(context, mask)
+
+        return self.encoder_norm(context), mask
+
+    @torch.jit.export
+    def source_keys(self, context: Tensor) -> Tuple[List[Tensor], List[Tensor]]:
+        """
+        :param context: len_src x n_keys x d_model
+        :return: the keys and values of the source attention of the layers, len_src x n_keys x d_model
+        """
+        keys: List[Tensor] = []
+        values: List[Tensor] = []
+        for layer in self.decoder_layers:
+            key, value = layer.source_keys(context)
+            keys.append(key)
+            values.append(value)
+
+        return keys, values
+
+    @torch.jit.export
+    def step(self, input: Tensor, time_step: int, keys: List[Tensor], values: List[Tensor], tgt_mask: Optional[Tensor],
+             src_keys: List[Tensor], src_values: List[Tensor], src_mask: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        :param input: n_rows, the last decoded tokens
+        :param time_step: position of the input tokens
+        :param keys: the self-attention keys of the layers, (time_step + 1) x n_rows x d_model,
+        the last row is filled by this step
+        :param values: same as the keys
+        :param tgt_mask: n_rows x 1 x (time_step + 1), the padded target positions (None if there is none)
+        :param src_keys: the keys of the source attention (source_keys), len_src x n_keys x d_model
+        :param src_values: same as src_keys
+        :param src_mask: n_keys x 1 x len_src
+        :return: the log-probs (n_rows x vocab_size, in float) and the source attention (n_rows x len_src)
+        """
+        emb = self.tgt_embedding(input).unsqueeze(0) * math.sqrt(self.model_size)
+        output = emb + self.positional_encoding(time_step, 1).type_as(emb)
+
+        coverage = torch.empty(0)
+        i = 0
+        for layer in self.decoder_layers:
+            output, coverage = layer(output, keys[i], values[i], tgt_mask, src_keys[i], src_values[i], src_mask)
+            i += 1
+
+        hidden = self.decoder_norm(output).squeeze(0)
+        log_prob = F.log_softmax(self.generator(hidden).float(), dim=-1)
+
+        return log_prob, coverage[:, -1, :]
+
+
+class ScriptedDecodingState(DecoderState):
+
+    def __init__(self, module, src, context, src_mask, beam_size=1, type=1, max_len=256):
+
+        self.beam_size = beam_size
+        # the legacy translator masks the attention with the original source
+        self.original_src = src
+        self.type = type
+        self.shortlist = None
+        self.time_step = 0
+
+        if type == 1:
+            # beam major rows: the source is repeated for every hypothesis
+            context = context.repeat(1, beam_size, 1)
+            src_mask = src_mask.repeat(beam_size, 1, 1)
+            self.shared_source = False
+            n_rows = context.size(1)
+        elif type == 2:
+            # sentence major rows: the source is kept once per sentence and shared by its hypotheses
+            self.shared_source = True
+            n_rows = context.size(1) * beam_size
+        else:
+            raise NotImplementedError
+
+        self.src_mask = src_mask
+        self.src_keys, self.src_values = module.source_keys(context)
+
+        self.kv_caches = [IncrementalCache(max_len, n_rows, module.model_size, dtype=context.dtype,
+                                           device=context.device) for _ in range(module.n_layers)]
+
+        # the padded target positions (the legacy translator feeds PAD after the end of a hypothesis),
+        # masked in the self-attention once there is one
+        self.tgt_pad = torch.zeros(max_len, n_rows, dtype=torch.bool, device=context.device)
+        self.has_pad = False
+
+    def advance(self):
+        """
+        :return: the self-attention keys and values of the layers, with room for the current step
+        """
+        keys, values = list(), list()
+        for cache in self.kv_caches:
+            key, value = cache.advance()
+            keys.append(key)
+            values.append(value)
+
+        return keys, values
+
+    def _reorder_incremental_state(self, reorder_state):
+        for cache in self.kv_caches:
+            cache.reorder(reorder_state)
+
+        self.tgt_pad = self.tgt_pad.index_select(1, reorder_state)
+
+        if self.shared_source:
+            # the beams never cross sentences, so the source only changes when sentences are removed
+            n_sents = reorder_state.size(0) // self.beam_size
+            if n_sents == self.src_mask.size(0):
+                return
+            source_order = reorder_state.view(n_sents, self.beam_size)[:, 0] // self.beam_size
+        else:
+            source_order = reorder_state
+
+        self.src_mask = self.src_mask.index_select(0, source_order)
+        self.src_keys = [key.index_select(1, source_order) for key in self.src_keys]
+        self.src_values = [value.index_select(1, source_order) for value in self.src_values]
+
+
+class ScriptedTransformer(object):
+    """
+    A Transformer loaded from a TorchScript archive (export_torchscript.py), with the interface
+    of the models used by the translators (encode, decode, create_decoder_state, step)
+    """
+
+    def __init__(self, module):
+        self.module = module
+        # default number of steps of the decoder caches (see renew_buffer)
+        self.max_len = 256
+
+    def encode(self, src):
+        """
+        :param src: source tensor, len_src x batch_size (time first, as in the Batch)
+        """
+        context, src_mask = self.module(src.transpose(0, 1))
+
+        return {'context': context, 'src_mask': src_mask}
+
+    def decode(self, batch, encoder_output=None):
+        """
+        The gold scores of the target of the batch, computed one step at a time
+        """
+        tgt_input = batch.get('target_input')
+        tgt_output = batch.get('target_output')
+
+        decoder_state = self.create_decoder_state(batch, type=2, max_len=tgt_input.size(0),
+                                                  encoder_output=encoder_output)
+
+        gold_scores = decoder_state.src_keys[0].new(tgt_input.size(1)).float().zero_()
+        gold_words = 0
+        allgold_scores = list()
+
+        for t in range(tgt_input.size(0)):
+            log_prob = self.step(tgt_input[:t + 1].t(), decoder_state)['log_prob']
+            tgt_t = tgt_output[t].unsqueeze(1)
+            scores = log_prob.gather(1, tgt_t)
+            scores.masked_fill_(tgt_t.eq(onmt.Constants.PAD), 0)
+            gold_scores += scores.squeeze(1)
+            gold_words += tgt_t.ne(onmt.Constants.PAD).sum().item()
+            allgold_scores.append(scores.squeeze(1))
+
+        return gold_words, gold_scores, allgold_scores
+
+    def renew_buffer(self, new_len):
+        # the positional encodings are computed on the fly, only the caches depend on the length
+        self.max_len = new_len
+
+    def create_decoder_state(self, batch, beam_size=1, type=1, max_len=None, encoder_output=None):
+
+        src = batch.get('source')
+
+        if encoder_output is None:
+            encoder_output = self.encode(src)
+
+        if max_len is None:
+            max_len = self.max_len + 1
+
+        return ScriptedDecodingState(self.module, src, encoder_output['context'], encoder_output['src_mask'],
+                                     beam_size=beam_size, type=type, max_len=max_len)
+
+    def step(self, input_t, decoder_state):
+        # only the last tokens are needed: 1 x n_rows (type 1) or n_rows x len (type 2)
+        input_t = input_t[-1] if decoder_state.type == 1 else input_t[:, -1]
+
+        time_step = decoder_state.time_step
+        pad = input_t.eq(onmt.Constants.PAD)
+        decoder_state.tgt_pad[time_step].copy_(pad)
+        decoder_state.has_pad = decoder_state.has_pad or bool(pad.any())
+        tgt_mask = decoder_state.tgt_pad[:time_step + 1].t().unsqueeze(1) if decoder_state.has_pad else None
+
+        keys, values = decoder_state.advance()
+        log_prob, coverage = self.module.step(input_t, time_step, keys, values, tgt_mask,
+                                              decoder_state.src_keys, decoder_state.src_values,
+                                              decoder_state.src_mask)
+        decoder_state.time_step += 1
+
+        output_dict = defaultdict(lambda: None)
+
+        output_dict['log_prob'] = log_prob
+        output_dict['coverage'] = coverage
+
+        return output_dict
+
+    def half(self):
+        self.module.half()
+        return self
+
+    def cuda(self):
+        self.module.cuda()
+        return self
+
+    def cpu(self):
+        self.module.cpu()
+        return self
+
+    def eval(self):
+        self.module.eval()
+        return self
+
+
+def export_scripted_model(model, model_opt, dicts, path, quantize=''):
+    """
+    Save a Transformer as a TorchScript archive, with the dictionaries and the options of the checkpoint
+    :param model: Transformer (text encoder) in float, on CPU
+    :param quantize: optional dynamic quantization of the linear layers (int8)
+    """
+    if model_opt.model != 'transformer' or model.encoder.input_type != 'text':
+        raise NotImplementedError('Only the Transformer with a text encoder can be exported')
+
+    if model.decoder.use_feature or onmt.Constants.residual_type == 'gated':
+        raise NotImplementedError('The target attributes and the gated residuals can not be exported')
+
+    if onmt.Constants.activation_layer == 'maxout':
+        raise NotImplementedError('The maxout feed forward layers can not be exported')
+
+    for module in model.modules():
+        if isinstance(module, XavierLinear) and module.weight_norm:
+            nn.utils.remove_weight_norm(module.linear)
+            module.weight_norm = False
+
+    module = ScriptedTransformerModule(model).eval()
+
+    if quantize:
+        module = torch.quantization.quantize_dynamic(module, {nn.Linear}, dtype=quantize_types[quantize])
+
+    module = torch.jit.script(module)
+
+    extra_files = {'dicts': pickle.dumps(dicts), 'opt': pickle.dumps(model_opt), 'quantize': quantize}
+    torch.jit.save(module, path, _extra_files=extra_files)
+
+
+def is_scripted_model(path):
+    """Whether the file is a TorchScript archive saved by export_scripted_model"""
+    if not zipfile.is_zipfile(path):
+        return False
+
+    with zipfile.ZipFile(path) as archive:
+        return any(name.endswith('extra/dicts') for name in archive.namelist())
+
+
+def load_scripted_model(path):
+    """
+    :return: the ScriptedTransformer and a checkpoint dictionary with the dictionaries, the options
+    and the quantization of the model
+    """
+    extra_files = {'dicts': '', 'opt': '', 'quantize': ''}
+    module = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+
+    checkpoint = {'dicts': pickle.loads(extra_files['dicts']), 'opt': pickle.loads(extra_files['opt']),
+                  'quantize': extra_files['quantize'].decode()}
+
+    return ScriptedTransformer(module), checkpoint
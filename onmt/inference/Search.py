@@ -82,7 +82,7 @@ class BeamSearch(Search):
             out=(self.scores_buf, self.indices_buf),
         )
         # torch.div(self.indices_buf, vocab_size, out=self.beams_buf)
-        self.beams_buf = torch.div(self.indices_buf, vocab_size)
+        self.beams_buf = self.indices_buf // vocab_size
         self.indices_buf.fmod_(vocab_size)
         return self.scores_buf, self.indices_buf, self.beams_buf
 
@@ -148,3 +148,102 @@ class DiverseBeamSearch(Search):
         self.indices_buf = torch.stack(indices_G, dim=2, out=self.indices_buf).view(bsz, -1)
         self.beams_buf = torch.stack(beams_G, dim=2, out=self.beams_buf).view(bsz, -1)
         return self.scores_buf, self.indices_buf, self.beams_buf
+
+
+class GreedySearch(Search):
+    """Greedy search: every hypothesis is extended with its own best token.
+
+    Each hypothesis only proposes one candidate, so with beam_size 1 a row
+    is finalized (and removed from the batch) as soon as its best token is EOS.
+    """
+
+    def __init__(self, tgt_dict):
+        super().__init__(tgt_dict)
+
+    def step(self, step, lprobs, scores):
+        super()._init_buffers(lprobs)
+        bsz, beam_size, vocab_size = lprobs.size()
+
+        torch.max(lprobs, dim=2, out=(self.scores_buf, self.indices_buf))
+
+        self.beams_buf = torch.arange(0, beam_size).repeat(bsz, 1).to(self.indices_buf)
+        if step > 0:
+            # make scores cumulative
+            self.scores_buf.add_(scores[:, :, step - 1])
+
+        return self.scores_buf, self.indices_buf, self.beams_buf
+
+
+class Sampling(Search):
+    """Multinomial sampling, optionally restricted to the top-k tokens
+    or to the smallest set of tokens whose probability exceeds top-p (nucleus sampling).
+
+    Each hypothesis samples its own next token, so the beam_size hypotheses
+    of a sentence are independent samples.
+    """
+
+    def __init__(self, tgt_dict, sampling_topk=-1, sampling_topp=-1.0):
+        super().__init__(tgt_dict)
+        self.sampling_topk = sampling_topk
+        self.sampling_topp = sampling_topp
+
+    def _sample_topp(self, lprobs):
+        """Keep the most likely tokens until their cumulative probability exceeds sampling_topp.
+
+        Return: A tuple of (probs, indices) where the tokens outside the nucleus have probability 0
+            and the last dimension is truncated to the largest nucleus in the batch
+        """
+        probs = lprobs.exp_()
+
+        sorted_probs, sorted_indices = probs.sort(descending=True)
+        cumsum_probs = sorted_probs.cumsum(dim=2)
+
+        # the first token always stays in, and so does the token crossing the threshold
+        mask = cumsum_probs.lt(self.sampling_topp)
+        last_included = mask.long().sum(dim=2, keepdim=True).clamp_(0, mask.size(2) - 1)
+        mask = mask.scatter_(2, last_included, 1)
+
+        max_dim = last_included.max().item() + 1
+        truncated_probs = sorted_probs[:, :, :max_dim].masked_fill_(~mask[:, :, :max_dim], 0)
+
+        return truncated_probs, sorted_indices[:, :, :max_dim]
+
+    def step(self, step, lprobs, scores):
+        super()._init_buffers(lprobs)
+        bsz, beam_size, vocab_size = lprobs.size()
+
+        if step == 0:
+            # at the first step all hypotheses are equal, so sample beam_size tokens from the first one
+            lprobs = lprobs[:, ::beam_size, :].contiguous()
+
+        if self.sampling_topp > 0:
+            probs, top_indices = self._sample_topp(lprobs)
+        elif self.sampling_topk > 0:
+            lprobs, top_indices = lprobs.topk(min(self.sampling_topk, vocab_size), dim=2)
+            probs = lprobs.exp_()
+        else:
+            probs = lprobs.exp_()
+            top_indices = None
+
+        # sample (the probabilities need not sum to one)
+        if step == 0:
+            self.indices_buf = torch.multinomial(probs.view(bsz, -1), beam_size, replacement=True)
+            probs = probs.expand(bsz, beam_size, probs.size(2))
+        else:
+            self.indices_buf = torch.multinomial(probs.view(bsz * beam_size, -1), 1, replacement=True)
+        self.indices_buf = self.indices_buf.view(bsz, beam_size)
+
+        # log probability of the sampled tokens
+        self.scores_buf = torch.gather(probs, dim=2, index=self.indices_buf.unsqueeze(-1)).log_().view(bsz, -1)
+
+        # map the sampled positions back to the vocabulary
+        if top_indices is not None:
+            self.indices_buf = torch.gather(top_indices.expand(bsz, beam_size, top_indices.size(2)),
+                                            dim=2, index=self.indices_buf.unsqueeze(-1)).squeeze(2)
+
+        self.beams_buf = torch.arange(0, beam_size).repeat(bsz, 1).to(self.indices_buf)
+        if step > 0:
+            # make scores cumulative
+            self.scores_buf.add_(torch.gather(scores[:, :, step - 1], dim=1, index=self.beams_buf))
+
+        return self.scores_buf, self.indices_buf, self.beams_buf
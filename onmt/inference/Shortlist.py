@@ -0,0 +1,56 @@
+import torch
+import onmt
+
+
+class Shortlist(object):
+    """
+    Lexical shortlist of the output vocabulary (built with build_shortlist.py)
+    The candidates of a batch are the most frequent target words, plus the target words
+    most associated with each source word of the batch. The output layer only projects
+    onto these words, which are normalized among themselves.
+
+    The table file contains:
+        table:    src_vocab_size x topk LongTensor of target ids for each source id (padded with PAD)
+        frequent: LongTensor of the most frequent target ids
+    """
+
+    def __init__(self, path, topk=-1, frequent=-1):
+        """
+        :param path: shortlist table built with build_shortlist.py
+        :param topk: number of target words kept for each source word (-1 for all those in the table)
+        :param frequent: number of most frequent target words always kept (-1 for all those in the table)
+        """
+        checkpoint = torch.load(path, map_location=lambda storage, loc: storage)
+
+        self.table = checkpoint['table']
+        self.frequent = checkpoint['frequent']
+
+        if topk >= 0:
+            self.table = self.table[:, :topk]
+        if frequent >= 0:
+            self.frequent = self.frequent[:frequent]
+
+        # these words can always be generated
+        self.special = torch.LongTensor([onmt.Constants.EOS, onmt.Constants.UNK])
+
+    def cuda(self):
+        self.table = self.table.cuda()
+        self.frequent = self.frequent.cuda()
+        self.special = self.special.cuda()
+        return self
+
+    def candidates(self, src, extra=None):
+        """
+        :param src: len_src x batch_size LongTensor of source ids
+        :param extra: optional LongTensor of target ids which have to be in the shortlist (e.g. the prefixes)
+        :return: sorted LongTensor of the target ids of the batch
+        """
+        ids = [self.special, self.frequent, self.table.index_select(0, src.contiguous().view(-1)).view(-1)]
+
+        if extra is not None:
+            ids.append(extra.contiguous().view(-1))
+
+        ids = torch.cat(ids)
+        ids = ids[ids.ne(onmt.Constants.PAD)]
+
+        return torch.unique(ids, sorted=True)
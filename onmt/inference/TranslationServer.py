@@ -0,0 +1,248 @@
+import asyncio
+import functools
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from onmt.inference.FastTranslator import FastTranslator
+
+
+class TranslationServer(object):
+    """
+    Serve a Translator (or FastTranslator) to concurrent clients with dynamic micro-batching.
+    Incoming sentences are queued; a batch is decoded as soon as max_batch_size sentences are
+    waiting or the oldest one has waited max_wait seconds.
+
+    Protocol: line-delimited JSON over a TCP socket
+        request:  {"id": 1, "src": "source sentence"}  or  {"cmd": "stats"}
+                  an optional "prefix" is kept as the beginning of the translation (FastTranslator only)
+        response: {"id": 1, "tgt": "translation", "score": -1.23}  or the statistics
+
+    Responses on one connection are written as soon as their batch is done,
+    so they can come back in a different order than the requests (use the id).
+    """
+
+    def __init__(self, translator, max_batch_size=32, max_wait=0.01, input_type='word', history_size=10000,
+                 max_pending=1024):
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        # maximum number of queued sentences, and of requests in progress on one connection (0 for no limit)
+        self.max_pending = max_pending
+        self.input_type = input_type
+
+        # only FastTranslator.translate takes the prefixes (prefix_data)
+        self.supports_prefix = isinstance(translator, FastTranslator)
+
+        self.queue = None
+        self.n_requests = 0
+        self.n_batches = 0
+        self.latencies = deque(maxlen=history_size)
+        self.batch_sizes = deque(maxlen=history_size)
+
+        # decoding runs in its own thread so that the event loop keeps accepting requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def tokenize(self, sentence):
+        if self.input_type == 'word':
+            return sentence.split()
+        elif self.input_type == 'char':
+            return list(sentence.strip())
+        else:
+            raise NotImplementedError("Input type unknown")
+
+    def detokenize(self, tokens):
+        if self.input_type == 'word':
+            return " ".join(tokens)
+        else:
+            return "".join(tokens)
+
+    async def translate(self, sentence, prefix=None):
+        """
+        Queue one sentence and wait for its translation
+        :param sentence: source sentence (string)
+        :param prefix: beginning of the translation to continue from (string, optional)
+        :return: a dictionary with the translation 'tgt' and its 'score'
+        """
+        if prefix and not self.supports_prefix:
+            raise ValueError("Prefixes are only supported with -fast_translate")
+
+        self.n_requests += 1
+        tokens = self.tokenize(sentence)
+        prefix_tokens = self.tokenize(prefix) if prefix else []
+
+        if len(tokens) == 0:
+            return {'tgt': '', 'score': 0.0}
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((tokens, prefix_tokens, future, time.time()))
+
+        return await future
+
+    async def _next_batch(self):
+        # block until the first request, then fill the batch until the deadline of that request
+        requests = [await self.queue.get()]
+        deadline = requests[0][-1] + self.max_wait
+
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                if self.queue.empty():
+                    break
+                requests.append(self.queue.get_nowait())
+                continue
+            try:
+                requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return requests
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            requests = await self._next_batch()
+            src_batch = [tokens for tokens, _, _, _ in requests]
+            prefix_batch = [prefix for _, prefix, _, _ in requests]
+
+            # the prefixes are only given if there are any (they are rejected in translate without FastTranslator)
+            if any(len(prefix) > 0 for prefix in prefix_batch):
+                translate = functools.partial(self.translator.translate, prefix_data=prefix_batch)
+            else:
+                translate = self.translator.translate
+
+            try:
+                outputs = await loop.run_in_executor(self.executor, translate, src_batch, [])
+            except Exception as e:
+                for _, _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            pred_batch, pred_score = outputs[0], outputs[1]
+            now = time.time()
+
+            for b, (_, _, future, arrival) in enumerate(requests):
+                self.latencies.append(now - arrival)
+                if not future.done():
+                    future.set_result({'tgt': self.detokenize(pred_batch[b][0]),
+                                       'score': float(pred_score[b][0])})
+
+            self.n_batches += 1
+            self.batch_sizes.append(len(requests))
+
+    def stats(self):
+        """Queue depth, number of requests and batches, latency percentiles (in ms), average batch size
+        and encoder cache hits"""
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if len(latencies) == 0:
+                return 0.0
+            return latencies[min(int(p / 100.0 * len(latencies)), len(latencies) - 1)] * 1000
+
+        return {'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+                'requests': self.n_requests,
+                'batches': self.n_batches,
+                'latency_p50': percentile(50),
+                'latency_p90': percentile(90),
+                'latency_p99': percentile(99),
+                'avg_batch_size': sum(self.batch_sizes) / max(len(self.batch_sizes), 1),
+                'encoder_cache_hits': self.translator.encoder_cache.hits,
+                'encoder_cache_misses': self.translator.encoder_cache.misses}
+
+    async def handle_request(self, line, writer):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            if request.get('cmd') == 'stats':
+                response = self.stats()
+            else:
+                response = await self.translate(request['src'], request.get('prefix'))
+        except Exception as e:
+            response = {'error': str(e)}
+
+        if request_id is not None:
+            response['id'] = request_id
+
+        writer.write((json.dumps(response) + '\n').encode('utf-8'))
+        await writer.drain()
+
+    async def handle_client(self, reader, writer):
+        # every line is handled concurrently, so that one connection can fill a batch.
+        # With max_pending, the connection is not read any further while that many of its requests
+        # are in progress (the finished requests are removed, so that a long-lived connection does not accumulate them)
+        pending = set()
+        slots = asyncio.Semaphore(self.max_pending) if self.max_pending > 0 else None
+        while True:
+            if slots is not None:
+                await slots.acquire()
+            line = await reader.readline()
+            if not line or len(line.strip()) == 0:
+                if slots is not None:
+                    slots.release()
+                if not line:
+                    break
+                continue
+            task = asyncio.ensure_future(self.handle_request(line.decode('utf-8'), writer))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            if slots is not None:
+                task.add_done_callback(lambda _: slots.release())
+
+        if len(pending) > 0:
+            await asyncio.wait(pending)
+        writer.close()
+
+    async def serve(self, host='127.0.0.1', port=5000):
+        # the requests wait in translate (queue.put) when max_pending sentences are queued
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        batcher = asyncio.ensure_future(self.batch_loop())
+
+        server = await asyncio.start_server(self.handle_client, host, port)
+        print("* Translation server listening on %s:%d" % (host, port), flush=True)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+    def run(self, host='127.0.0.1', port=5000):
+        asyncio.run(self.serve(host, port))
+
+
+async def run_client(sentences, host='127.0.0.1', port=5000, n_connections=1):
+    """
+    Stand-in client: send the sentences over n_connections concurrent connections
+    (round robin) and collect the translations in the input order
+    :return: list of translations and the statistics of the server
+    """
+
+    async def connection(ids):
+        reader, writer = await asyncio.open_connection(host, port)
+        for i in ids:
+            writer.write((json.dumps({'id': i, 'src': sentences[i]}) + '\n').encode('utf-8'))
+        await writer.drain()
+
+        results = dict()
+        for _ in ids:
+            response = json.loads((await reader.readline()).decode('utf-8'))
+            results[response['id']] = response
+        writer.close()
+        return results
+
+    outputs = [None] * len(sentences)
+    groups = [list(range(len(sentences)))[c::n_connections] for c in range(n_connections)]
+    for results in await asyncio.gather(*[connection(ids) for ids in groups if len(ids) > 0]):
+        for i, response in results.items():
+            outputs[i] = response
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write((json.dumps({'cmd': 'stats'}) + '\n').encode('utf-8'))
+    stats = json.loads((await reader.readline()).decode('utf-8'))
+    writer.close()
+
+    return outputs, stats
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import onmt, math
+from collections import OrderedDict
 
 class Generator(nn.Module):
 
@@ -20,16 +21,38 @@ class Generator(nn.Module):
         self.linear.bias.data.zero_()
 
         
-    def forward(self, input, log_softmax=True):
+    def forward(self, input, log_softmax=True, shortlist=None):
+        """
+        :param input: hidden states, ... x hidden_size
+        :param log_softmax: normalize the output (otherwise the logits are returned)
+        :param shortlist: optional (weight, bias) from select_shortlist: only these
+        output words are projected (and normalized over), in the order of the shortlist
+        """
         
         # added float to the end 
-        logits = self.linear(input).float()
+        if shortlist is None:
+            logits = self.linear(input).float()
+        else:
+            logits = F.linear(input, *shortlist).float()
         
         if log_softmax:
             output = F.log_softmax(logits, dim=-1)
         else:
             output = logits
         return output
+
+    def select_shortlist(self, ids):
+        """
+        :param ids: LongTensor of output word ids
+        :return: the rows of the output projection for these words (weight and bias)
+        """
+        weight, bias = self.linear.weight, self.linear.bias
+
+        if callable(weight):
+            # dynamically quantized layer: the selected rows are used in float
+            weight, bias = weight().dequantize(), bias()
+
+        return weight.index_select(0, ids), bias.index_select(0, ids)
         
 
 class NMTModel(nn.Module):
@@ -52,25 +75,31 @@ class NMTModel(nn.Module):
         self.encoder.mark_pretrained()
         self.decoder.mark_pretrained()
         
+    def restores_state(self, param_name):
+        """Whether the saved value is loaded (the positional encodings and the masks are computed again)"""
+        if 'positional_encoder' in param_name:
+            return False
+        if 'time_transformer' in param_name:
+            if self.encoder is not None and self.encoder.time == 'positional_encoding':
+                return False
+        if param_name == 'decoder.mask':
+            return False
+
+        return True
+
     def load_state_dict(self, state_dict, strict=True):
         
-        def condition(param_name):
-            
-            if 'positional_encoder' in param_name:
-                return False
-            if 'time_transformer' in param_name:
-                if self.encoder is not None and self.encoder.time == 'positional_encoding':
-                    return False
-            if param_name == 'decoder.mask':
-                return False
-            
-            return True
+        condition = self.restores_state
 
         #restore old generated if necessay for loading
         if "generator.linear.weight" in state_dict and type(self.generator) is nn.ModuleList:
             self.generator = self.generator[0]
 
-        filtered = {k: v for k, v in state_dict.items() if condition(k)}
+        filtered = OrderedDict((k, v) for k, v in state_dict.items() if condition(k))
+
+        # the version of the saved layers (needed by the quantized layers to read their state)
+        if hasattr(state_dict, '_metadata'):
+            filtered._metadata = state_dict._metadata
 
         model_dict = self.state_dict()
 
@@ -98,12 +127,48 @@ class DecoderState(object):
     the model.  But can also be used for implementing various forms of
     input_feeding and non-recurrent models.
     Modules need to implement this to utilize beam search decoding.
+
+    The states are created by create_decoder_state(batch, beam_size, type, ...) of the models:
+        type 1 (onmt.Translator): the rows are beam major (hypothesis k of sentence s in row k * n_sents + s).
+            The step gets the last tokens only (1 x n_rows, time first), the state keeps
+            the previous ones (concat_input_seq).
+        type 2 (FastTranslator): the rows are sentence major (row s * beam_size + k).
+            The step gets all the tokens decoded so far (n_rows x len, batch first).
+    Whatever the type, _reorder_incremental_state selects rows of every tensor of the state:
+    this is how the beams are reordered and the finished sentences pruned.
     """
 
+    def _reorder_incremental_state(self, reorder_state):
+        """
+        :param reorder_state: LongTensor of the rows (hypotheses) to keep, in their new order
+        """
+        raise NotImplementedError
+
     def update_beam(self, beam, b, remaining_sents, idx):
 
         raise NotImplementedError
 
+    def update_beams(self, beam_origin, remaining_sents):
+        """
+        update_beam for all the remaining sentences at once (onmt.BatchedBeam)
+        :param beam_origin: remaining_sents x beam_size LongTensor, the beam each new hypothesis comes from
+        :param remaining_sents: number of sentences being decoded
+        """
+        self._reorder_incremental_state(self.beam_reorder_index(beam_origin, remaining_sents))
+
+    # in this section, the sentences that are still active are
+    # compacted so that the decoder is not run on completed sentences
     def prune_complete_beam(self, active_idx, remaining_sents):
 
-        raise NotImplementedError
+        beams = torch.arange(self.beam_size, device=active_idx.device).unsqueeze(1)
+        self._reorder_incremental_state((beams * remaining_sents + active_idx.unsqueeze(0)).view(-1))
+
+    @staticmethod
+    def beam_reorder_index(beam_origin, remaining_sents):
+        """
+        The states are laid out beam major (hypothesis k of sentence s in row k * remaining_sents + s)
+        :return: the rows to select so that each hypothesis gets the state of its origin
+        """
+        sents = torch.arange(remaining_sents, device=beam_origin.device).unsqueeze(0)
+
+        return (beam_origin.t() * remaining_sents + sents).contiguous().view(-1)
@@ -187,12 +187,13 @@ class DlclTransformerDecoder(TransformerDecoder):
         src = decoder_state.src.transpose(0, 1) if decoder_state.src is not None else None
         atbs = decoder_state.tgt_atb
 
-        if decoder_state.input_seq is None:
-            decoder_state.input_seq = input
-        else:
-            # concatenate the last input to the previous input sequence
-            decoder_state.input_seq = torch.cat([decoder_state.input_seq, input], 0)
-        input = decoder_state.input_seq.transpose(0, 1)
+        if decoder_state.concat_input_seq:
+            if decoder_state.input_seq is None:
+                decoder_state.input_seq = input
+            else:
+                # concatenate the last input to the previous input sequence
+                decoder_state.input_seq = torch.cat([decoder_state.input_seq, input], 0)
+            input = decoder_state.input_seq.transpose(0, 1)
         input_ = input[:,-1].unsqueeze(1)
 
         """ Embedding: batch_size x 1 x d_model """
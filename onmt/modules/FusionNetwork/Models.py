@@ -75,9 +75,17 @@ class FusionNetwork(nn.Module):
         self.tm_model.decoder.renew_buffer(new_len)
         self.lm_model.decoder.renew_buffer(new_len)
 
-    def decode(self, batch):
+    def encode(self, src):
+        """
+        :param src: source tensor, len_src x batch_size (time first, as in the Batch)
+        :return: the output of the translation model encoder
+        """
+        return self.tm_model.encode(src)
+
+    def decode(self, batch, encoder_output=None):
         """
         :param batch: (onmt.Dataset.Batch) an object containing tensors needed for training
+        :param encoder_output: output of encode(), if the encoder has already been run on the batch
         :return: gold_scores (torch.Tensor) log probs for each sentence
                  gold_words  (Int) the total number of non-padded tokens
                  allgold_scores (list of Tensors) log probs for each word in the sentence
@@ -93,7 +101,9 @@ class FusionNetwork(nn.Module):
         batch_size = tgt_input.size(0)
 
         # (1) we decode using language model
-        context = self.tm_model.encoder(src)['context']
+        if encoder_output is None:
+            encoder_output = self.tm_model.encoder(src)
+        context = encoder_output['context']
 
         if (hasattr(self,
             'autoencoder') and self.autoencoder and self.autoencoder.representation == "EncoderHiddenState"):
@@ -155,16 +165,20 @@ class FusionNetwork(nn.Module):
 
         return output_dict
 
-    def create_decoder_state(self, batch, beam_size=1):
+    def create_decoder_state(self, batch, beam_size=1, type=1, max_len=None, encoder_output=None):
         """
         Generate a new decoder state based on the batch input
         :param batch: Batch object (may not contain target during decoding)
         :param beam_size: Size of beam used in beam search
+        :param type: 1 for onmt.Translator, 2 for FastTranslator (see DecoderState)
+        :param max_len: maximum number of decoding steps (preallocated caches of the translation model)
+        :param encoder_output: output of encode(), if the encoder has already been run on the batch
         :return:
         """
-        tm_decoder_state = self.tm_model.create_decoder_state(batch, beam_size=beam_size)
+        tm_decoder_state = self.tm_model.create_decoder_state(batch, beam_size=beam_size, type=type, max_len=max_len,
+                                                              encoder_output=encoder_output)
 
-        lm_decoder_state = self.lm_model.create_decoder_state(batch, beam_size=beam_size)
+        lm_decoder_state = self.lm_model.create_decoder_state(batch, beam_size=beam_size, type=type)
 
         decoder_state = FusionDecodingState(tm_decoder_state, lm_decoder_state)
 
@@ -180,12 +194,24 @@ class FusionDecodingState(DecoderState):
 
         self.original_src = tm_state.original_src
         self.beam_size = tm_state.beam_size
+        self.concat_input_seq = tm_state.concat_input_seq
+        self.shortlist = None
+
+    def _reorder_incremental_state(self, reorder_state):
+
+        self.tm_state._reorder_incremental_state(reorder_state)
+        self.lm_state._reorder_incremental_state(reorder_state)
 
     def update_beam(self, beam, b, remaining_sents, idx):
 
         self.tm_state.update_beam(beam, b, remaining_sents, idx)
         self.lm_state.update_beam(beam, b, remaining_sents, idx)
 
+    def update_beams(self, beam_origin, remaining_sents):
+
+        self.tm_state.update_beams(beam_origin, remaining_sents)
+        self.lm_state.update_beams(beam_origin, remaining_sents)
+
     # in this section, the sentences that are still active are
     # compacted so that the decoder is not run on completed sentences
     def prune_complete_beam(self, active_idx, remaining_sents):
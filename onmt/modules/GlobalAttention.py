@@ -51,6 +51,9 @@ class MultiHeadAttention(nn.Module):
         self.fc_value = Bottle(Linear(d_model, h * self.d_head, bias=False))
         self.fc_concat = Bottle(Linear(h * self.d_head, d_model, bias=False))
 
+        # the projections of group_linear merged into one layer (see fuse_projections)
+        self.fc_shared = None
+
         self.sm = nn.Softmax(dim=-1)
 
         if static:
@@ -58,6 +61,44 @@ class MultiHeadAttention(nn.Module):
         else:
             self.attn_dropout = nn.Dropout(attn_p)
 
+    def _grouped_linears(self):
+        # the projections computed together by group_linear
+        if self.share == 1:
+            return [self.fc_query.function.linear, self.fc_key.function.linear, self.fc_value.function.linear]
+        elif self.share == 2:
+            return [self.fc_key.function.linear, self.fc_value.function.linear]
+        else:
+            return None
+
+    def fuse_projections(self):
+        """
+        Merge the projections computed together by group_linear (query, key and value for share=1,
+        key and value for share=2) into one linear layer holding the concatenated weights,
+        instead of concatenating the weights at every call. Needed before quantizing the model,
+        because the weights of quantized layers can not be concatenated.
+        The merged projections are removed, so that their weights are only stored once.
+        """
+        linears = self._grouped_linears()
+        if linears is None or self.fc_shared is not None:
+            return
+
+        weight = torch.cat([linear.weight.data for linear in linears], dim=0)
+        fc_shared = nn.Linear(weight.size(1), weight.size(0), bias=False).to(weight)
+        fc_shared.weight.data.copy_(weight)
+
+        self.fc_shared = fc_shared
+
+        if self.share == 1:
+            self.fc_query = None
+        self.fc_key = None
+        self.fc_value = None
+
+    def _group_linear(self, input):
+        if self.fc_shared is not None:
+            return self.fc_shared(input)
+
+        return group_linear(self._grouped_linears(), input)
+
     def forward(self, query, key, value, mask, query_mask=None, value_mask=None):
 
         len_query, b = query.size(0), query.size(1)
@@ -68,12 +109,11 @@ class MultiHeadAttention(nn.Module):
         # batch_size*h x len_query x d_head
         # project inputs to multi-heads
         if self.share == 1:
-            shared_qkv = group_linear(
-                [self.fc_query.function.linear, self.fc_key.function.linear, self.fc_value.function.linear], query)
+            shared_qkv = self._group_linear(query)
             proj_query, proj_key, proj_value = shared_qkv.chunk(3, dim=-1)
         elif self.share == 2:
             proj_query = self.fc_query(query)  # batch_size x len_query x h*d_head
-            shared_kv = group_linear([self.fc_key.function.linear, self.fc_value.function.linear], key)
+            shared_kv = self._group_linear(key)
             proj_key, proj_value = shared_kv.chunk(2, dim=-1)
         else:
             proj_query = self.fc_query(query, mask=query_mask)
@@ -121,10 +161,13 @@ class MultiHeadAttention(nn.Module):
             # proj_query = self.fc_query(query, mask=query_mask)   # batch_size*h x len_query x d_head
             # proj_key   = self.fc_key(key, mask=key_mask)             # batch_size x len_key x h*d_head
             # proj_value = self.fc_value(value, mask=value_mask)       # batch_size x len_key x h*d_head
-            shared_qkv = group_linear(
-                [self.fc_query.function.linear, self.fc_key.function.linear, self.fc_value.function.linear], query)
+            shared_qkv = self._group_linear(query)
             proj_query, proj_key, proj_value = shared_qkv.chunk(3, dim=-1)
-            if buffer is not None and 'k' in buffer and 'v' in buffer:
+            if buffer is not None and 'kv_cache' in buffer:
+                # preallocated cache: write the new step in place and read back the filled prefix
+                proj_key, proj_value = buffer['kv_cache'].append(proj_key, proj_value)
+                len_key, b_ = proj_key.size(0), proj_key.size(1)
+            elif buffer is not None and 'k' in buffer and 'v' in buffer:
                 proj_key = torch.cat([buffer['k'], proj_key], dim=0)  # time first
                 buffer['k'] = proj_key
                 proj_value = torch.cat([buffer['v'], proj_value], dim=0)  # time first
@@ -143,13 +186,17 @@ class MultiHeadAttention(nn.Module):
             else:
                 if buffer is None:
                     buffer = dict()
-                shared_kv = group_linear([self.fc_key.function.linear, self.fc_value.function.linear], key)
+                shared_kv = self._group_linear(key)
                 proj_key, proj_value = shared_kv.chunk(2, dim=-1)
                 buffer['c_k'] = proj_key
                 buffer['c_v'] = proj_value
         else:
             raise NotImplementedError
 
+        if b_ != b:
+            out, coverage = self._shared_source_step(proj_query, proj_key, proj_value, mask)
+            return out, coverage, buffer
+
         q, k, v = proj_query, proj_key, proj_value
 
         # prepare the shape for applying softmax
@@ -177,4 +224,140 @@ class MultiHeadAttention(nn.Module):
 
         out = self.fc_concat(out)
 
-        return out, coverage, buffer
\ No newline at end of file
+        return out, coverage, buffer
+
+    def _shared_source_step(self, proj_query, proj_key, proj_value, mask):
+        """
+        Attention of the hypotheses of a beam search on keys and values stored once per sentence.
+        The query rows are sentence-major (row s * beam_size + k is the hypothesis k of the sentence s),
+        so the queries of the beam_size hypotheses of a sentence attend to its keys in one matrix product.
+
+        Inputs Shapes:
+            proj_query: len_query x (batch_size * beam_size) x h*d_head
+            proj_key:   len_key x batch_size x h*d_head
+            proj_value: len_key x batch_size x h*d_head
+            mask:       batch_size x len_query x len_key or broadcastable
+        Outputs Shapes:
+            out:      len_query x (batch_size * beam_size) x d_model
+            coverage: (batch_size * beam_size) x len_query x len_key
+        """
+        len_query, b = proj_query.size(0), proj_query.size(1)
+        len_key, b_ = proj_key.size(0), proj_key.size(1)
+        beam_size = b // b_
+
+        # sentences*h x beam_size*len_query x d_head
+        q = proj_query.contiguous().view(len_query, b_, beam_size, self.h, self.d_head)
+        q = q.permute(1, 3, 2, 0, 4).contiguous().view(b_ * self.h, beam_size * len_query, self.d_head)
+        k = proj_key.contiguous().view(len_key, b_ * self.h, self.d_head).transpose(0, 1)
+        v = proj_value.contiguous().view(len_key, b_ * self.h, self.d_head).transpose(0, 1)
+
+        q = q * (self.d_head ** -0.5)
+
+        attns = torch.bmm(q, k.transpose(1, 2))  # sentences*h x beam_size*len_query x len_key
+
+        attns = attns.view(b_, self.h, beam_size, len_query, len_key)
+        mask_ = mask.unsqueeze(1).unsqueeze(1)
+        # FP16 support: cast to float and back
+        attns = attns.float().masked_fill_(mask_, -float('inf')).type_as(attns)
+        attns = F.softmax(attns.float(), dim=-1).type_as(attns)
+        # return mean attention from all heads as coverage
+        coverage = torch.mean(attns, dim=1).view(b, len_query, len_key)
+        attns = attns.view(b_ * self.h, beam_size * len_query, len_key)
+
+        # apply attns on value
+        out = torch.bmm(attns, v)  # sentences*h x beam_size*len_query x d_head
+        out = out.view(b_, self.h, beam_size, len_query, self.d_head)
+        out = out.permute(3, 0, 2, 1, 4).contiguous().view(len_query, b, self.d)
+
+        out = self.fc_concat(out)
+
+        return out, coverage
+
+class IncrementalCache(object):
+    """Preallocated key/value storage for incremental self-attention
+    Instead of concatenating the new key/value to the buffer at every step,
+    the tensors are allocated once for the maximum length and filled in place.
+
+    Args:
+        max_len:    maximum number of time steps stored
+        batch_size: number of rows (batch_size * beam_size during beam search)
+        d_model:    dimension of model
+        dtype, device: type and location of the storage (same as the projections)
+
+    Params:
+        length: number of time steps currently filled (the cursor)
+
+    Outputs Shapes (of append):
+        keys:   length x batch_size x d_model
+        values: length x batch_size x d_model
+    """
+
+    def __init__(self, max_len, batch_size, d_model, dtype=torch.float, device='cpu'):
+
+        self.max_len = max_len
+        self.batch_size = batch_size
+        self.capacity = batch_size
+        self.d_model = d_model
+        self.length = 0
+
+        # two copies of the storage, so that reordering the beams never reads and writes the same memory
+        numel = max_len * batch_size * d_model
+        self.key_storage = [torch.empty(numel, dtype=dtype, device=device) for _ in range(2)]
+        self.value_storage = [torch.empty(numel, dtype=dtype, device=device) for _ in range(2)]
+        self.current = 0
+
+    def _view(self, storage, length, batch_size):
+        # time first layout: the filled prefix is always contiguous
+        return storage[:length * batch_size * self.d_model].view(length, batch_size, self.d_model)
+
+    def keys(self):
+        return self._view(self.key_storage[self.current], self.length, self.batch_size)
+
+    def values(self):
+        return self._view(self.value_storage[self.current], self.length, self.batch_size)
+
+    def append(self, key, value):
+        """
+        :param key: len_query x batch_size x d_model (projected key of the new steps)
+        :param value: len_query x batch_size x d_model
+        :return: the keys and values of all steps so far
+        """
+        start = self.length
+        end = start + key.size(0)
+        assert end <= self.max_len, "Incremental cache is full (%d steps)" % self.max_len
+        assert key.size(1) == self.batch_size
+
+        self.length = end
+        keys, values = self.keys(), self.values()
+        keys[start:end].copy_(key)
+        values[start:end].copy_(value)
+
+        return keys, values
+
+    def advance(self, steps=1):
+        """
+        Make room for the next steps, which are written in place by the caller
+        (the last rows of the returned tensors)
+        :return: the keys and values of all steps so far, including the new ones
+        """
+        assert self.length + steps <= self.max_len, "Incremental cache is full (%d steps)" % self.max_len
+        self.length += steps
+
+        return self.keys(), self.values()
+
+    def reorder(self, new_order):
+        """
+        Select the rows (beams) to keep for the next step
+        :param new_order: LongTensor of row indices, may be shorter than the batch (finished sentences)
+        """
+        new_size = new_order.size(0)
+        assert new_size <= self.capacity
+        other = 1 - self.current
+
+        for storage in [self.key_storage, self.value_storage]:
+            source = self._view(storage[self.current], self.length, self.batch_size)
+            target = self._view(storage[other], self.length, new_size)
+            torch.index_select(source, 1, new_order, out=target)
+
+        self.current = other
+        self.batch_size = new_size
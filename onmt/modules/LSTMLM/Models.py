@@ -103,12 +103,13 @@ class LSTMLMDecoder(nn.Module):
         """
         buffers = decoder_state.attention_buffers
 
-        if decoder_state.input_seq is None:
-            decoder_state.input_seq = input
-        else:
-            # concatenate the last input to the previous input sequence
-            decoder_state.input_seq = torch.cat([decoder_state.input_seq, input], 0)
-        input = decoder_state.input_seq.transpose(0, 1)
+        if decoder_state.concat_input_seq:
+            if decoder_state.input_seq is None:
+                decoder_state.input_seq = input
+            else:
+                # concatenate the last input to the previous input sequence
+                decoder_state.input_seq = torch.cat([decoder_state.input_seq, input], 0)
+            input = decoder_state.input_seq.transpose(0, 1)
         input_ = input[:,-1].unsqueeze(1)
 
         # output_buffer = list()
@@ -215,14 +216,14 @@ class LSTMLM(NMTModel):
         pass
 
 
-    def create_decoder_state(self, batch, beam_size=1):
+    def create_decoder_state(self, batch, beam_size=1, type=1, **kwargs):
 
-        return LSTMDecodingState(None, None, beam_size=beam_size, model_size=self.model_size)
+        return LSTMDecodingState(None, None, beam_size=beam_size, model_size=self.model_size, type=type)
 
 
 class LSTMDecodingState(TransformerDecodingState):
 
-    def __init__(self, src, context, beam_size=1, model_size=512):
+    def __init__(self, src, context, beam_size=1, model_size=512, type=1):
 
         # if audio only take one dimension since only used for mask
 
@@ -233,6 +234,18 @@ class LSTMDecodingState(TransformerDecodingState):
         self.c = None
         self.model_size = model_size
 
+        # a language model has no source, the state is only the input and the attention buffers
+        self.src = None
+        self.original_src = None
+        self.context = None
+        self.src_mask = None
+        self.tgt_atb = None
+        self.attention_buffers = dict()
+        self.kv_caches = list()
+        self.shortlist = None
+        self.concat_input_seq = type == 1
+        self.time_step = 0
+
 
     def update_beam(self, beam, b, remaining_sents, idx):
 
@@ -260,6 +273,25 @@ class LSTMDecodingState(TransformerDecodingState):
                 sent_states.data.copy_(sent_states.data.index_select(
                             1, beam[b].getCurrentOrigin()))
 
+    def update_beams(self, beam_origin, remaining_sents):
+
+        reorder = self.beam_reorder_index(beam_origin, remaining_sents)
+
+        if self.src is not None:
+            self.src = self.src.index_select(1, reorder)
+
+        if self.input_seq is not None:
+            self.input_seq = self.input_seq.index_select(1, reorder)
+
+        for l in self.attention_buffers:
+            buffer_ = self.attention_buffers[l]
+
+            if buffer_ is None:
+                continue
+
+            for k in buffer_:
+                buffer_[k] = buffer_[k].index_select(1, reorder)
+
     # in this section, the sentences that are still active are
     # compacted so that the decoder is not run on completed sentences
     def prune_complete_beam(self, active_idx, remaining_sents):
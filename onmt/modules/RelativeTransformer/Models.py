@@ -125,6 +125,9 @@ class RelativeTransformerDecoder(TransformerDecoder):
 
     """
 
+    # the relative attention keeps its own buffers of queries, keys and values
+    incremental_cache = False
+
     def __init__(self, opt, dicts, positional_encoder, attribute_embeddings=None, ignore_source=False):
         self.death_rate = opt.death_rate
         self.layer_modules = None
@@ -232,14 +235,18 @@ class RelativeTransformerDecoder(TransformerDecoder):
         src = decoder_state.src.transpose(0, 1) if decoder_state.src is not None else None
         atbs = decoder_state.tgt_atb
 
-        if decoder_state.input_seq is None:
-            decoder_state.input_seq = input
-        else:
-            # concatenate the last input to the previous input sequence
-            decoder_state.input_seq = torch.cat([decoder_state.input_seq, input], 0)
-        # input = decoder_state.input_seq.transpose(0, 1)
+        if decoder_state.concat_input_seq:
+            if decoder_state.input_seq is None:
+                decoder_state.input_seq = input
+            else:
+                # concatenate the last input to the previous input sequence
+                decoder_state.input_seq = torch.cat([decoder_state.input_seq, input], 0)
+            # input = decoder_state.input_seq.transpose(0, 1)
 
-        input = decoder_state.input_seq  # no need to transpose because time first
+            input = decoder_state.input_seq  # no need to transpose because time first
+        else:
+            # the whole input sequence is given (batch first)
+            input = input.transpose(0, 1)
         input_ = input[-1, :].unsqueeze(0)
 
         """ Embedding: batch_size x 1 x d_model """
@@ -359,6 +359,6 @@ class PositionalEncoding(nn.Module):
         else:
             # out = word_emb + Variable(self.pos_emb[:len_seq, :][-1, :], requires_grad=False)
             time_emb = self.pos_emb[len_seq-1, :] # 1 x dim
-            # out should have size bs x 1 x dim
-            out = word_emb + time_emb.unsqueeze(0).repeat(word_emb.size(0), 1, 1).type_as(word_emb)
+            # out should have size bs x 1 x dim (broadcast over the batch)
+            out = word_emb + time_emb.type_as(word_emb)
         return out
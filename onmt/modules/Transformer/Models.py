@@ -4,6 +4,7 @@ import torch.nn as nn
 from onmt.modules.Transformer.Layers import EncoderLayer, DecoderLayer, PositionalEncoding, \
     PrePostProcessing
 from onmt.modules.BaseModel import NMTModel, Reconstructor, DecoderState
+from onmt.modules.GlobalAttention import IncrementalCache
 import onmt
 from onmt.modules.WordDrop import embedded_dropout, switchout
 from torch.utils.checkpoint import checkpoint
@@ -216,6 +217,9 @@ class TransformerDecoder(nn.Module):
 
     """
 
+    # the layers can write their self-attention keys and values into preallocated caches (fast decoding)
+    incremental_cache = True
+
     def __init__(self, opt, embedding, positional_encoder, attribute_embeddings=None, ignore_source=False):
 
         super(TransformerDecoder, self).__init__()
@@ -407,11 +411,14 @@ class TransformerDecoder(nn.Module):
         check = input_.gt(self.word_lut.num_embeddings)
         emb = self.word_lut(input_)
 
+        # number of tokens decoded so far, including the current one
+        len_tgt = decoder_state.time_step + 1
+
         """ Adding positional encoding """
         if self.time == 'positional_encoding':
             # print(emb.size())
             emb = emb * math.sqrt(self.model_size)
-            emb = self.time_transformer(emb, t=input.size(1))
+            emb = self.time_transformer(emb, t=len_tgt)
         else:
             # prev_h = buffer[0] if buffer is None else None
             # emb = self.time_transformer(emb, prev_h)
@@ -449,12 +456,10 @@ class TransformerDecoder(nn.Module):
         else:
             mask_src = None
 
-        len_tgt = input.size(1)
-        mask_tgt = input.eq(onmt.Constants.PAD).byte().unsqueeze(1)
-        mask_tgt = mask_tgt + self.mask[:len_tgt, :len_tgt].type_as(mask_tgt)
+        # only the last row of the mask is needed during decoding (because the input of the network is only the last step)
+        mask_tgt = input[:, :len_tgt].eq(onmt.Constants.PAD).byte().unsqueeze(1)
+        mask_tgt = mask_tgt + self.mask[len_tgt - 1, :len_tgt].type_as(mask_tgt)
         mask_tgt = torch.gt(mask_tgt, 0)
-        # only get the final step of the mask during decoding (because the input of the network is only the last step)
-        mask_tgt = mask_tgt[:, -1, :].unsqueeze(1)
 
         if torch_version >= 1.2:
             mask_tgt = mask_tgt.bool()
@@ -469,6 +474,8 @@ class TransformerDecoder(nn.Module):
 
             decoder_state.update_attention_buffer(buffer, i)
 
+        decoder_state.time_step += 1
+
         # From Google T2T
         # if normalization is done in layer_preprocess, then it should also be done
         # on the output, since the output can grow very large, being the sum of
@@ -555,9 +562,17 @@ class Transformer(NMTModel):
 
         return output_dict
 
-    def decode(self, batch):
+    def encode(self, src):
+        """
+        :param src: source tensor, len_src x batch_size (time first, as in the Batch)
+        :return: dictionary with the context (len_src x batch_size x d_model) and the source mask
+        """
+        return self.encoder(src.transpose(0, 1))
+
+    def decode(self, batch, encoder_output=None):
         """
         :param batch: (onmt.Dataset.Batch) an object containing tensors needed for training
+        :param encoder_output: output of encode(), if the encoder has already been run on the batch
         :return: gold_scores (torch.Tensor) log probs for each sentence
                  gold_words  (Int) the total number of non-padded tokens
                  allgold_scores (list of Tensors) log probs for each word in the sentence
@@ -573,7 +588,9 @@ class Transformer(NMTModel):
         tgt_input = tgt_input.transpose(0, 1)
         batch_size = tgt_input.size(0)
 
-        context = self.encoder(src)['context']
+        if encoder_output is None:
+            encoder_output = self.encoder(src)
+        context = encoder_output['context']
 
         if hasattr(self, 'autoencoder') and self.autoencoder \
                 and self.autoencoder.representation == "EncoderHiddenState":
@@ -619,7 +636,7 @@ class Transformer(NMTModel):
 
         hidden, coverage = self.decoder.step(input_t, decoder_state)
         # squeeze to remove the time step dimension
-        log_prob = self.generator[0](hidden.squeeze(0))
+        log_prob = self.generator[0](hidden.squeeze(0), shortlist=decoder_state.shortlist)
 
         last_coverage = coverage[:, -1, :].squeeze(1)
 
@@ -630,32 +647,51 @@ class Transformer(NMTModel):
 
         return output_dict
 
-    def create_decoder_state(self, batch, beam_size=1, type=1):
+    def create_decoder_state(self, batch, beam_size=1, type=1, max_len=None, encoder_output=None):
         """
         Generate a new decoder state based on the batch input
         :param batch: Batch object (may not contain target during decoding)
         :param beam_size: Size of beam used in beam search
+        :param max_len: maximum number of decoding steps. If given (fast decoding only),
+        the self-attention buffers are preallocated for that many steps
+        :param encoder_output: output of encode(), if the encoder has already been run on the batch
         :return:
         """
         src = batch.get('source')
         tgt_atb = batch.get('target_atb')
 
-        src_transposed = src.transpose(0, 1)
-        encoder_output = self.encoder(src_transposed)
+        if encoder_output is None:
+            encoder_output = self.encode(src)
+
+        # the self-attention keys and values are only preallocated for the layers supporting it
+        n_layers = len(self.decoder.layer_modules) if self.decoder.incremental_cache else 0
 
         decoder_state = TransformerDecodingState(src, tgt_atb, encoder_output['context'], encoder_output['src_mask'],
-                                                 beam_size=beam_size, model_size=self.model_size, type=type)
+                                                 beam_size=beam_size, model_size=self.model_size, type=type,
+                                                 max_len=max_len, n_layers=n_layers)
 
         return decoder_state
 
 
 class TransformerDecodingState(DecoderState):
 
-    def __init__(self, src, tgt_atb, context, src_mask, beam_size=1, model_size=512, type=1):
+    def __init__(self, src, tgt_atb, context, src_mask, beam_size=1, model_size=512, type=1,
+                 max_len=None, n_layers=0):
 
         self.beam_size = beam_size
         self.model_size = model_size
         self.attention_buffers = dict()
+        self.kv_caches = list()
+
+        # output projection restricted to the vocabulary shortlist of the batch (Generator.select_shortlist)
+        self.shortlist = None
+
+        # number of decoded steps, which is the position of the next input
+        self.time_step = 0
+
+        # whether the source side (context, mask and source keys/values) has one row per sentence
+        # instead of one row per hypothesis
+        self.shared_source = False
 
         if type == 1:
             # if audio only take one dimension since only used for mask
@@ -693,9 +729,14 @@ class TransformerDecodingState(DecoderState):
             bsz = context.size(1)
             new_order = torch.arange(bsz).view(-1, 1).repeat(1, self.beam_size).view(-1)
             new_order = new_order.to(context.device)
-            self.context = context.index_select(1, new_order)
-            self.src = src.index_select(1, new_order)  # because src is batch first
-            self.src_mask = src_mask.index_select(0, new_order)
+            self.original_src = src
+            # the source side is kept once per sentence: the hypotheses of a sentence are consecutive rows
+            # (sentence-major), and the source attention broadcasts the context over them
+            self.shared_source = True
+            self.context = context
+            self.src = src
+            self.src_mask = src_mask
+            self.input_seq = None
             self.concat_input_seq = False
 
             if tgt_atb is not None:
@@ -707,9 +748,22 @@ class TransformerDecodingState(DecoderState):
             else:
                 self.tgt_atb = None
 
+            # preallocate the self-attention keys and values: max_len x (B*beam) x H for each layer
+            if max_len is not None:
+                for l in range(n_layers):
+                    cache = IncrementalCache(max_len, new_order.size(0), model_size,
+                                             dtype=self.context.dtype, device=self.context.device)
+                    self.kv_caches.append(cache)
+                    self.attention_buffers[l] = {'kv_cache': cache}
+
         else:
             raise NotImplementedError
 
+    @property
+    def length(self):
+        """Number of decoded steps stored in the preallocated caches"""
+        return self.kv_caches[0].length if len(self.kv_caches) > 0 else 0
+
 
     def update_attention_buffer(self, buffer, layer):
 
@@ -754,6 +808,32 @@ class TransformerDecodingState(DecoderState):
                 sent_states.data.copy_(sent_states.data.index_select(
                     1, beam[b].getCurrentOrigin()))
 
+    def update_beams(self, beam_origin, remaining_sents):
+
+        if self.beam_size == 1:
+            return
+
+        reorder = self.beam_reorder_index(beam_origin, remaining_sents)
+
+        if self.src is not None:
+            self.src = self.src.index_select(1, reorder)
+
+        if self.input_seq is not None:
+            self.input_seq = self.input_seq.index_select(1, reorder)
+
+        if self.tgt_atb is not None:
+            for i in self.tgt_atb:
+                self.tgt_atb[i] = self.tgt_atb[i].index_select(0, reorder)
+
+        for l in self.attention_buffers:
+            buffer_ = self.attention_buffers[l]
+
+            if buffer_ is None:
+                continue
+
+            for k in buffer_:
+                buffer_[k] = buffer_[k].index_select(1, reorder)
+
     # in this section, the sentences that are still active are
     # compacted so that the decoder is not run on completed sentences
     def prune_complete_beam(self, active_idx, remaining_sents):
@@ -804,19 +884,50 @@ class TransformerDecodingState(DecoderState):
             for k in buffer_:
                 buffer_[k] = update_active_with_hidden(buffer_[k])
 
-    # For the new decoder version only
     def _reorder_incremental_state(self, reorder_state):
-        self.context = self.context.index_select(1, reorder_state)
+        if self.shared_source:
+            # the beams never cross sentences, so the source only changes when sentences are removed
+            n_sents = reorder_state.size(0) // self.beam_size
+            if self.context is not None and n_sents != self.context.size(1):
+                source_order = reorder_state.view(n_sents, self.beam_size)[:, 0] // self.beam_size
+                self._reorder_source(source_order)
+        else:
+            self._reorder_source(reorder_state)
 
-        self.src_mask = self.src_mask.index_select(0, reorder_state)
+        if self.input_seq is not None:
+            self.input_seq = self.input_seq.index_select(1, reorder_state)
 
         if self.tgt_atb is not None:
             for i in self.tgt_atb:
                 self.tgt_atb[i] = self.tgt_atb[i].index_select(0, reorder_state)
 
+        for cache in self.kv_caches:
+            cache.reorder(reorder_state)
+
         for l in self.attention_buffers:
             buffer_ = self.attention_buffers[l]
             if buffer_ is not None:
                 for k in buffer_.keys():
+                    if k == 'kv_cache' or (self.shared_source and k in ['c_k', 'c_v']):
+                        continue
                     t_, br_, d_ = buffer_[k].size()
                     buffer_[k] = buffer_[k].index_select(1, reorder_state)  # 1 for time first
+
+    def _reorder_source(self, source_order):
+        """Select the rows of the source side: the context, the mask and the source keys/values of the layers"""
+        if self.context is not None:
+            self.context = self.context.index_select(1, source_order)
+
+        if self.src is not None:
+            self.src = self.src.index_select(1, source_order)
+
+        if self.src_mask is not None:
+            self.src_mask = self.src_mask.index_select(0, source_order)
+
+        if self.shared_source:
+            for l in self.attention_buffers:
+                buffer_ = self.attention_buffers[l]
+                if buffer_ is not None:
+                    for k in ['c_k', 'c_v']:
+                        if k in buffer_:
+                            buffer_[k] = buffer_[k].index_select(1, source_order)
@@ -10,6 +10,7 @@ import time, datetime
 import os
 from onmt.ModelConstructor import init_model_parameters
 from onmt.utils import checkpoint_paths, normalize_gradients
+from onmt.data_utils.Prefetcher import BatchPrefetcher
 from apex import amp
 
 
@@ -186,7 +187,8 @@ class XETrainer(BaseTrainer):
         self.model.reset_states()
 
         if resume:
-            train_data.batch_order = batch_order
+            if batch_order is not None:
+                train_data.batchOrder = batch_order
             train_data.set_index(iteration)
             print("Resuming from iteration: %d" % iteration)
         else:
@@ -204,12 +206,21 @@ class XETrainer(BaseTrainer):
         num_accumulated_sents = 0
         denom = 3584
         nan = False
+
+        curriculum = (epoch < opt.curriculum)
+
+        # the batches of the epoch are built ahead in a background thread (in pinned memory)
+        prefetch = opt.prefetch if hasattr(opt, 'prefetch') else 0
+        if prefetch > 0:
+            train_batches = iter(BatchPrefetcher(train_data, n_samples - iteration, curriculum=curriculum,
+                                                 prefetch=prefetch, pin_memory=self.cuda, fp16=opt.fp16))
         
         for i in range(iteration, n_samples):
 
-            curriculum = (epoch < opt.curriculum)
-
-            batches = [train_data.next(curriculum=curriculum)[0]]
+            if prefetch > 0:
+                batches = [next(train_batches)]
+            else:
+                batches = [train_data.next(curriculum=curriculum)[0]]
 
             if(len(self.additional_data) > 0 and
                 i % self.additional_data_ratio[0] == 0):
@@ -226,7 +237,7 @@ class XETrainer(BaseTrainer):
             for b in range(len(batches)):
                 batch = batches[b]
                 if self.cuda:
-                    batch.cuda(fp16=self.opt.fp16)
+                    batch.cuda(fp16=self.opt.fp16, non_blocking=prefetch > 0)
             
                 oom = False
                 try:
@@ -112,6 +112,9 @@ def make_parser(parser):
                         help='Label smoothing value for loss functions.')
     parser.add_argument('-scheduled_sampling_rate', type=float, default=0.0,
                         help='Scheduled sampling rate.')
+    parser.add_argument('-prefetch', type=int, default=2,
+                        help="""Number of training batches built ahead in a background thread
+                        (0 builds them in the training loop).""")
     parser.add_argument('-curriculum', type=int, default=-1,
                         help="""For this many epochs, order the minibatches based
                         on source sequence length. Sometimes setting this to 1 will
@@ -606,10 +606,6 @@ def main():
         print('Saving data to memory indexed data files')
         from onmt.data_utils.MMapIndexedDataset import MMapIndexedDatasetBuilder
 
-        if opt.asr:
-            print("ASR data format isn't compatible with memory indexed format")
-            raise AssertionError
-
         # save dicts in this format
         torch.save(dicts, opt.save_data + '.dict.pt')
 
@@ -624,7 +620,8 @@ def main():
                 dtype = np.int32
 
             if set == 'src' and opt.asr:
-                dtype = np.double
+                # the speech features are stored as matrices (frames x features)
+                dtype = np.float16 if opt.fp16 else np.float32
 
             train_data = MMapIndexedDatasetBuilder(opt.save_data + ".train.%s.bin" % set, dtype=dtype)
 
@@ -640,7 +637,7 @@ def main():
                 continue
 
             if set == 'src' and opt.asr:
-                dtype = np.double
+                dtype = np.float16 if opt.fp16 else np.float32
 
             valid_data = MMapIndexedDatasetBuilder(opt.save_data + ".valid.%s.bin" % set, dtype=dtype)
 
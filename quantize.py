@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+from __future__ import division
+
+import os
+import argparse
+import torch
+from onmt.ModelConstructor import build_model
+from onmt.inference.Release import load_checkpoint
+from onmt.inference.Quantization import quantize_model
+
+
+parser = argparse.ArgumentParser(description='quantize.py')
+
+parser.add_argument('-model', required=True,
+                    help='Path to model .pt file')
+parser.add_argument('-output', default='model.quantized.pt',
+                    help="""Path to output quantized model""")
+parser.add_argument('-quantize', default='int8',
+                    help="""Type of the quantized weights: int8""")
+
+
+def main():
+
+    opt = parser.parse_args()
+
+    print("Loading model from %s ..." % opt.model)
+    checkpoint = load_checkpoint(opt.model)
+
+    if 'quantize' in checkpoint and checkpoint['quantize']:
+        raise ValueError("%s is already quantized" % opt.model)
+
+    model_opt = checkpoint['opt']
+    dicts = checkpoint['dicts']
+
+    model = build_model(model_opt, dicts)
+    model.load_state_dict(checkpoint['model'])
+    model.eval()
+
+    model = quantize_model(model, opt.quantize)
+
+    # the translator quantizes the model again before loading this state
+    save_checkpoint = {
+            'model': model.state_dict(),
+            'dicts': dicts,
+            'opt': model_opt,
+            'quantize': opt.quantize,
+            'epoch': -1,
+            'iteration': -1,
+            'batchOrder': None,
+            'optim': None
+    }
+
+    print("Saving quantized model to %s" % opt.output)
+
+    torch.save(save_checkpoint, opt.output)
+
+    print("Size: %.1f MB -> %.1f MB" % (os.path.getsize(opt.model) / 2 ** 20, os.path.getsize(opt.output) / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
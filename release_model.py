@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+from __future__ import division
+
+import os
+import argparse
+import torch
+from onmt.ModelConstructor import build_model
+from onmt.inference.Release import save_release, check_release, data_file_path
+
+
+parser = argparse.ArgumentParser(description='release_model.py')
+
+parser.add_argument('-model', required=True,
+                    help='Path to model .pt file')
+parser.add_argument('-output', default='model.release.pt',
+                    help="""Path to the release checkpoint, which is given to translate.py as -model.
+                    The weights are written to the same path with .bin appended""")
+parser.add_argument('-fp16', action='store_true',
+                    help="""Write the weights in half precision (they are copied
+                    when the model is loaded in float)""")
+
+
+def main():
+
+    opt = parser.parse_args()
+
+    print("Loading model from %s ..." % opt.model)
+    checkpoint = torch.load(opt.model, map_location=lambda storage, loc: storage)
+
+    if 'quantize' in checkpoint and checkpoint['quantize']:
+        raise ValueError("%s is quantized, the release format only stores the float weights" % opt.model)
+
+    model_opt = checkpoint['opt']
+    dicts = checkpoint['dicts']
+
+    model = build_model(model_opt, dicts)
+    model.load_state_dict(checkpoint['model'])
+
+    print("Saving the weights to %s and the options and dictionaries to %s"
+          % (data_file_path(opt.output), opt.output))
+
+    save_release(model, model_opt, dicts, opt.output, fp16=opt.fp16)
+
+    mismatches = check_release(model.state_dict(), opt.output, fp16=opt.fp16)
+    if len(mismatches) > 0:
+        raise RuntimeError("The weights read back from %s differ from the model: %s"
+                           % (opt.output, ", ".join(mismatches)))
+
+    size = os.path.getsize(opt.output) + os.path.getsize(data_file_path(opt.output))
+    print("Size: %.1f MB -> %.1f MB" % (os.path.getsize(opt.model) / 2 ** 20, size / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -48,6 +48,9 @@ parser.add_argument('-beam_size', type=int, default=5,
                     help='Beam size')
 parser.add_argument('-batch_size', type=int, default=30,
                     help='Batch size')
+parser.add_argument('-encoder_cache_size', type=int, default=0,
+                    help="""Number of distinct source sentences whose encoder outputs are kept
+                    and reused for repeated inputs (0 to disable)""")
 parser.add_argument('-max_sent_length', type=int, default=2048,
                     help='Maximum sentence length.')
 parser.add_argument('-replace_unk', action="store_true",
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+import onmt
+import onmt.Markdown
+import torch
+import argparse
+import asyncio
+import sys
+from onmt.inference.TranslationServer import TranslationServer, run_client
+from onmt.inference.Options import add_decoding_options
+
+parser = argparse.ArgumentParser(description='server.py')
+onmt.Markdown.add_md_help_argument(parser)
+
+parser.add_argument('-model',
+                    help='Path to model .pt file (required to run the server)')
+parser.add_argument('-host', default='127.0.0.1',
+                    help='Address to listen on (or to connect to with -client)')
+parser.add_argument('-port', type=int, default=5000,
+                    help='Port to listen on (or to connect to with -client)')
+parser.add_argument('-max_wait', type=float, default=10,
+                    help='Maximum time (in milliseconds) a request waits for its micro-batch to fill up')
+parser.add_argument('-max_pending', type=int, default=1024,
+                    help="""Maximum number of sentences waiting for translation, and of requests in progress
+                    on one connection: the server stops reading the connection until some are done (0 for no limit)""")
+parser.add_argument('-client', action='store_true',
+                    help="""Run a stand-in client instead of the server: the lines of -src are sent
+                    to the server and the translations are written to -output in the same order""")
+parser.add_argument('-client_connections', type=int, default=1,
+                    help='Number of concurrent connections opened by the client')
+parser.add_argument('-src', default='stdin',
+                    help='Source sentences for the client (one line per sentence)')
+parser.add_argument('-output', default='stdout',
+                    help='Output of the client')
+
+parser.add_argument('-batch_size', type=int, default=32,
+                    help='Maximum number of sentences in a micro-batch')
+
+# the options of the translators, shared with translate.py
+add_decoding_options(parser)
+
+
+def main():
+    opt = parser.parse_args()
+
+    if opt.client:
+        in_file = sys.stdin if opt.src == "stdin" else open(opt.src)
+        sentences = [line.strip() for line in in_file]
+
+        outputs, stats = asyncio.run(run_client(sentences, opt.host, opt.port, opt.client_connections))
+
+        outF = sys.stdout if opt.output == "stdout" else open(opt.output, 'w')
+        for output in outputs:
+            outF.write(output.get('tgt', '') + '\n')
+        outF.flush()
+
+        print("Server statistics: %s" % " ".join("%s=%s" % (k, stats[k]) for k in sorted(stats)), file=sys.stderr)
+        return
+
+    if opt.model is None:
+        parser.error("-model is required to run the server")
+
+    opt.cuda = opt.gpu > -1
+    if opt.cuda:
+        torch.cuda.set_device(opt.gpu)
+
+    opt.n_best = 1
+
+    if not opt.fast_translate:
+        translator = onmt.Translator(opt)
+    else:
+        from onmt.inference.FastTranslator import FastTranslator
+        translator = FastTranslator(opt)
+
+    server = TranslationServer(translator, max_batch_size=opt.batch_size, max_wait=opt.max_wait / 1000.0,
+                               max_pending=opt.max_pending,
+                               input_type=opt.input_type)
+    server.run(opt.host, opt.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -118,12 +118,17 @@ def main():
         train_src = MMapIndexedDataset(train_path + '.src')
         train_tgt = MMapIndexedDataset(train_path + '.tgt')
 
+        # the speech features are stored as matrices (preprocess.py -asr -format mmem)
+        data_type = "audio" if opt.encoder_type == "audio" else "text"
+
         train_data = onmt.Dataset(train_src,
                                   train_tgt,
                                   batch_size_words=opt.batch_size_words,
-                                  data_type="text",
+                                  data_type=data_type,
                                   batch_size_sents=opt.batch_size_sents,
-                                  multiplier=opt.batch_size_multiplier)
+                                  multiplier=opt.batch_size_multiplier,
+                                  reshape_speech=opt.reshape_speech,
+                                  augment=opt.augment_speech)
 
         valid_path = opt.data + '.valid'
         valid_src = MMapIndexedDataset(valid_path + '.src')
@@ -132,8 +137,9 @@ def main():
         valid_data = onmt.Dataset(valid_src,
                                   valid_tgt,
                                   batch_size_words=opt.batch_size_words,
-                                  data_type="text",
-                                  batch_size_sents=opt.batch_size_sents)
+                                  data_type=data_type,
+                                  batch_size_sents=opt.batch_size_sents,
+                                  reshape_speech=opt.reshape_speech)
         elapse = str(datetime.timedelta(seconds=int(time.time() - start)))
         print("Done after %s" % elapse)
 
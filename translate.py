@@ -12,30 +12,22 @@ import sys
 import h5py as h5
 import numpy as np
 import apex
+from onmt.inference.Options import add_decoding_options
+from onmt.Dataset import allocate_batches
 
 parser = argparse.ArgumentParser(description='translate.py')
 onmt.Markdown.add_md_help_argument(parser)
 
 parser.add_argument('-model', required=True,
                     help='Path to model .pt file')
-parser.add_argument('-lm', required=False,
-                    help='Path to language model .pt file. Used for cold fusion')
-parser.add_argument('-autoencoder', required=False,
-                    help='Path to autoencoder .pt file')
-parser.add_argument('-input_type', default="word",
-                    help="Input type: word/char")
 parser.add_argument('-src', required=True,
                     help='Source sequence to decode (one line per sequence)')
-parser.add_argument('-attributes', default="",
-                    help='Attributes for the decoder. Split them by |   ')
 parser.add_argument('-stride', type=int, default=1,
                     help="Stride on input features")
 parser.add_argument('-concat', type=int, default=1,
                     help="Concate sequential audio features to decrease sequence length")
 parser.add_argument('-asr_format', default="h5", required=False,
                     help="Format of asr data h5 or scp")
-parser.add_argument('-encoder_type', default='text',
-                    help="Type of encoder to use. Options are [text|img|audio].")
 parser.add_argument('-previous_context', type=int, default=0,
                     help="Number of previous sentence for context")
 
@@ -44,52 +36,19 @@ parser.add_argument('-tgt',
 parser.add_argument('-output', default='pred.txt',
                     help="""Path to output the predictions (each line will
                     be the decoded sequence""")
-parser.add_argument('-beam_size', type=int, default=5,
-                    help='Beam size')
 parser.add_argument('-batch_size', type=int, default=30,
                     help='Batch size')
-parser.add_argument('-max_sent_length', type=int, default=256,
-                    help='Maximum sentence length.')
-parser.add_argument('-replace_unk', action="store_true",
-                    help="""Replace the generated UNK tokens with the source
-                    token that had highest attention weight. If phrase_table
-                    is provided, it will lookup the identified source token and
-                    give the corresponding target token. If it is not provided
-                    (or the identified source token does not exist in the
-                    table) then it will copy the source token""")
-parser.add_argument('-start_with_bos', action="store_true",
-                    help="""Add BOS token to the top of the source sentence""")
-# parser.add_argument('-phrase_table',
-#                     help="""Path to source-target dictionary to replace UNK
-#                     tokens. See README.md for the format of this file.""")
-parser.add_argument('-verbose', action="store_true",
-                    help='Print scores and predictions for each sentence')
-parser.add_argument('-sampling', action="store_true",
-                    help='Using multinomial sampling instead of beam search')
-parser.add_argument('-dump_beam', type=str, default="",
-                    help='File to dump beam information to.')
-parser.add_argument('-bos_token', type=str, default="<s>",
-                    help='BOS Token (used in multilingual model). Default is <s>.')
-parser.add_argument('-no_bos_gold', action="store_true",
-                    help='BOS Token (used in multilingual model). Default is <s>.')
-parser.add_argument('-n_best', type=int, default=1,
-                    help="""If verbose is set, will output the n_best
-                    decoded sentences""")
-parser.add_argument('-alpha', type=float, default=0.6,
-                    help="""Length Penalty coefficient""")
-parser.add_argument('-beta', type=float, default=0.0,
-                    help="""Coverage penalty coefficient""")
+parser.add_argument('-sort_by_length', action='store_true',
+                    help="""Sort the input by source length and decode it in batches of similar length.
+                    The output is written in the original order""")
+parser.add_argument('-sort_window', type=int, default=100000,
+                    help='Number of input lines loaded and sorted together when -sort_by_length is used')
 parser.add_argument('-print_nbest', action='store_true',
                     help='Output the n-best list instead of a single sentence')
-parser.add_argument('-ensemble_op', default='mean', help="""Ensembling operator""")
-parser.add_argument('-normalize', action='store_true',
-                    help='To normalize the scores based on output length')
-parser.add_argument('-fp16', action='store_true',
-                    help='To use floating point 16 in decoding')
-parser.add_argument('-gpu', type=int, default=-1,
-                    help="Device to run on")
-parser.add_argument('-fast_translate', action='store_true',
-                    help='Using the fast decoder')
+
+# the options of the translators, shared with server.py
+add_decoding_options(parser)
+
 
 def reportScore(name, score_total, words_total):
     print("%s AVG SCORE: %.4f, %s PPL: %.4f" % (
@@ -108,6 +67,20 @@ def lenPenalty(s, l, alpha):
     return s / l_term
 
 
+def allocateBatches(lengths, batch_size_sents, batch_size_words):
+    """
+    Group the sentences by decreasing length into mini-batches (with Dataset.allocate_batch:
+    the padded size of a batch must not exceed batch_size_words)
+    :return: a list of batches, each batch is a list of sentence indices
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.argsort(-lengths, kind='stable')
+
+    batches = allocate_batches(lengths[order], batch_size_sents, batch_size_words)
+
+    return [order[batch].tolist() for batch in batches]
+
+
 def getSentenceFromTokens(tokens, input_type):
     if input_type == 'word':
         sent = " ".join(tokens)
@@ -139,16 +112,13 @@ def main():
     count = 0
 
     tgtF = open(opt.tgt) if opt.tgt else None
-    #
-    # if opt.dump_beam != "":
-    #     import json
-    #     translator.initBeamAccum()
 
     in_file = None
 
     if opt.src == "stdin":
         in_file = sys.stdin
         opt.batch_size = 1
+        opt.sort_by_length = False
     elif opt.encoder_type == "audio" and opt.asr_format  == "h5":
         in_file = h5.File(opt.src, 'r')
     elif opt.encoder_type == "audio" and opt.asr_format == "scp":
@@ -164,6 +134,14 @@ def main():
         from onmt.inference.FastTranslator import FastTranslator
         translator = FastTranslator(opt)
 
+    # the beams are only recorded by the default translator
+    if opt.dump_beam != "":
+        import json
+        translator.init_beam_accum()
+
+    # when sorting, a whole window of sentences is read before translating
+    read_size = opt.sort_window if opt.sort_by_length else opt.batch_size
+
     # Audio processing for the source batch
     if opt.encoder_type == "audio":
 
@@ -221,18 +199,25 @@ def main():
 
                 tgt_batch += [tgt_tokens]
 
-            if len(src_batch) < opt.batch_size:
+            if len(src_batch) < read_size:
                 continue
 
-            print("Batch size:", len(src_batch), len(tgt_batch))
-            pred_batch, pred_score, pred_length, gold_score, num_gold_words, all_gold_scores = translator.translate(
-                src_batch, tgt_batch, type='asr')
-
-            print("Result:", len(pred_batch))
-            count, pred_score, pred_words, gold_score, goldWords = translateBatch(opt, tgtF, count, outF, translator,
-                                                                               src_batch, tgt_batch, pred_batch, pred_score,
-                                                                               pred_length, gold_score, num_gold_words,
-                                                                               all_gold_scores, opt.input_type)
+            if opt.sort_by_length:
+                count, pred_score, pred_words, gold_score, goldWords = translateSorted(opt, tgtF, count, outF,
+                                                                                      translator, src_batch, tgt_batch,
+                                                                                      opt.input_type, type='asr')
+            else:
+                print("Batch size:", len(src_batch), len(tgt_batch))
+                pred_batch, pred_score, pred_length, gold_score, num_gold_words, all_gold_scores = translator.translate(
+                    src_batch, tgt_batch, type='asr')
+
+                print("Result:", len(pred_batch))
+                count, pred_score, pred_words, gold_score, goldWords = translateBatch(opt, tgtF, count, outF,
+                                                                                   translator, src_batch, tgt_batch,
+                                                                                   pred_batch, pred_score,
+                                                                                   pred_length, gold_score,
+                                                                                   num_gold_words, all_gold_scores,
+                                                                                   opt.input_type)
             pred_score_total += pred_score
             pred_words_total += pred_words
             gold_score_total += gold_score
@@ -240,7 +225,16 @@ def main():
             src_batch, tgt_batch = [], []
 
         # catch the last batch
-        if len(src_batch) != 0:
+        if len(src_batch) != 0 and opt.sort_by_length:
+            count, pred_score, pred_words, gold_score, goldWords = translateSorted(opt, tgtF, count, outF,
+                                                                                  translator, src_batch, tgt_batch,
+                                                                                  opt.input_type, type='asr')
+            pred_score_total += pred_score
+            pred_words_total += pred_words
+            gold_score_total += gold_score
+            gold_words_total += goldWords
+            src_batch, tgt_batch = [], []
+        elif len(src_batch) != 0:
             print("Batch size:", len(src_batch), len(tgt_batch))
             pred_batch, pred_score, pred_length, gold_score, num_gold_words, all_gold_scores = translator.translate(
                 src_batch,
@@ -276,23 +270,28 @@ def main():
                         raise NotImplementedError("Input type unknown")
                     tgt_batch += [tgt_tokens]
 
-                if len(src_batch) < opt.batch_size:
+                if len(src_batch) < read_size:
                     continue
             else:
                 # at the end of file, check last batch
                 if len(src_batch) == 0:
                     break
 
-            # actually done beam search from the model
-            pred_batch, pred_score, pred_length, gold_score, num_gold_words, all_gold_scores = translator.translate(src_batch,
-                                                                                                            tgt_batch)
-
-            # convert output tensor to words
-            count, pred_score, pred_words, gold_score, goldWords = translateBatch(opt, tgtF, count, outF, translator,
-                                                                               src_batch, tgt_batch,
-                                                                               pred_batch, pred_score, pred_length,
-                                                                               gold_score, num_gold_words,
-                                                                               all_gold_scores, opt.input_type)
+            if opt.sort_by_length:
+                count, pred_score, pred_words, gold_score, goldWords = translateSorted(opt, tgtF, count, outF,
+                                                                                      translator, src_batch, tgt_batch,
+                                                                                      opt.input_type)
+            else:
+                # actually done beam search from the model
+                pred_batch, pred_score, pred_length, gold_score, num_gold_words, all_gold_scores = \
+                    translator.translate(src_batch, tgt_batch)
+
+                # convert output tensor to words
+                count, pred_score, pred_words, gold_score, goldWords = translateBatch(opt, tgtF, count, outF,
+                                                                                   translator, src_batch, tgt_batch,
+                                                                                   pred_batch, pred_score, pred_length,
+                                                                                   gold_score, num_gold_words,
+                                                                                   all_gold_scores, opt.input_type)
             pred_score_total += pred_score
             pred_words_total += pred_words
             gold_score_total += gold_score
@@ -310,6 +309,45 @@ def main():
         json.dump(translator.beam_accum, open(opt.dump_beam, 'w'))
 
 
+def translateSorted(opt, tgtF, count, outF, translator, src_window, tgt_window, input_type, type='mt'):
+    """
+    Translate a window of sentences in mini-batches of similar source length
+    and write the outputs back in the original order
+    """
+    n_sents = len(src_window)
+    pred_batch, pred_score, pred_length, gold_score = [None] * n_sents, [None] * n_sents, [None] * n_sents, \
+        [None] * n_sents
+    num_gold_words = 0
+
+    batches = allocateBatches([len(src) for src in src_window], opt.batch_size,
+                              opt.batch_size_words // opt.beam_size)
+
+    for batch_ids in batches:
+        src_batch = [src_window[i] for i in batch_ids]
+        tgt_batch = [tgt_window[i] for i in batch_ids] if tgtF else []
+
+        if type == 'asr':
+            outputs = translator.translate(src_batch, tgt_batch, type='asr')
+        else:
+            outputs = translator.translate(src_batch, tgt_batch)
+        batch_pred, batch_pred_score, batch_pred_length, batch_gold_score, batch_gold_words, _ = outputs
+
+        # restore the original order of the sentences
+        for j, i in enumerate(batch_ids):
+            pred_batch[i] = batch_pred[j]
+            pred_score[i] = batch_pred_score[j]
+            pred_length[i] = batch_pred_length[j] if len(batch_pred_length) > 0 else None
+            gold_score[i] = batch_gold_score[j]
+        num_gold_words += batch_gold_words
+
+    # the fast translator does not report the lengths
+    if any(length is None for length in pred_length):
+        pred_length = []
+
+    return translateBatch(opt, tgtF, count, outF, translator, src_window, tgt_window, pred_batch, pred_score,
+                          pred_length, gold_score, num_gold_words, [], input_type)
+
+
 def translateBatch(opt, tgtF, count, outF, translator, src_batch, tgt_batch, pred_batch, pred_score, pred_length, gold_score,
                    num_gold_words, all_gold_scores, input_type):
     original_pred_batch = pred_batch
@@ -350,7 +388,7 @@ def translateBatch(opt, tgtF, count, outF, translator, src_batch, tgt_batch, pre
             outF.write(getSentenceFromTokens(pred_batch[b][0], input_type) + '\n')
             outF.flush()
         else:
-            for n in range(opt.n_best):
+            for n in range(len(pred_batch[b])):
                 idx = n
                 output_sent = getSentenceFromTokens(pred_batch[b][idx], input_type)
                 out_str = "%s ||| %.4f" % (output_sent, pred_score[b][idx])
@@ -376,7 +414,7 @@ def translateBatch(opt, tgtF, count, outF, translator, src_batch, tgt_batch, pre
                 print ()
             if opt.print_nbest:
                 print('\n BEST HYP:')
-                for n in range(opt.n_best):
+                for n in range(len(pred_batch[b])):
                     idx = n
                     out_str = "%s ||| %.4f" % (" ".join(pred_batch[b][idx]), pred_score[b][idx])
                     print(out_str)